@@ -14,14 +14,61 @@ PATH_TO_DATA_CURRENT_STATE = f'{REPOSITORY_PATH}/CUG_MEDIO_current_state.csv'
 PATH_TO_SOURCE_DATA = f'{REPOSITORY_PATH}/test_list_encrypted.bin'
 PATH_TO_REPORT_MEDIOTHEKEN = f'{REPOSITORY_PATH}/report_cug_mediotheken.csv'
 PATH_TO_REPORT_VERWALTUNG = f'{REPOSITORY_PATH}/report_cug_verwaltung.csv'
+PATH_TO_REPORT_RECONCILIATION = f'{REPOSITORY_PATH}/report_cug_reconciliation.csv'
+PATH_TO_ENCRYPTED_LOG = f'{REPOSITORY_PATH}/log/encrypted_log.txt'
+PATH_TO_RETRY_QUEUE = f'{REPOSITORY_PATH}/CUG_retry_queue.csv'
+PATH_TO_RETRY_DEAD_LETTER = f'{REPOSITORY_PATH}/CUG_retry_dead_letter.csv'
+PATH_TO_DEPARTED_MEMBERS = f'{REPOSITORY_PATH}/CUG_MEDIO_departed_members.csv'
+
+# Lock file of the process using the local repository, outside of the repository removed by the clones
+REPOSITORY_LOCK_PATH = f'{REPOSITORY_PATH}.lock'
 
 # Git repository configuration
 REPOSITORY_URL = 'git.ag.ch/abn/abn_slsp_exchange.git'
 REPOSITORY_TOKEN_KEY = 'rw_slsp_token'
 
+# Number of worker processes processing the Mediotheken list, each one handles one shard
+NB_WORKERS = 1
+
+# Connections kept alive to each host of the Alma API, per process. The API calls of a process
+# are sequential, one connection is enough. Worker processes each have their own pool
+HTTP_POOL_SIZE = 1
+
+# Rows of the Mediotheken list sharing a surname are searched with one query by surname
+# when there are at least MATCHING_BLOCK_MIN_ROWS of them, else by surname and first name
+MATCHING_BLOCK_MIN_ROWS = 3
+
+# Rows of the Mediotheken list read, processed and written at once
+CHUNK_SIZE = 1000
+
+# Scheduler configuration (daemon mode)
+SCHEDULER_INTERVAL = 3600  # seconds between two cycles
+
 # Analytics report configuration
+# Snapshot of the users having one of the CUGs or an email address with domain ag.ch
+# Columns: Primary Identifier, User Group Code and the email columns, for example Preferred Email and
+# Email Address (one row per email address of the users)
+MEMBERSHIP_ANALYTICS_REPORT_PATH = ('/shared/Aargauer Kantonsbibliothek 41SLSP_ABN/Reports/'
+                                    'SLSP_ABN_reports_on_request/CUG/Users_with_cug_or_ag_ch_email')
+# Users with an email address with domain ag.ch without the CUG, used to add the Verwaltung
+# CUG when the membership snapshot is not available
 VERWALTUNG_ANALYTICS_REPORT_PATH = ('/shared/Aargauer Kantonsbibliothek 41SLSP_ABN/Reports/'
                                     'SLSP_ABN_reports_on_request/CUG/Users_with_ag_ch_email_and_not_user_group')
 
+# Reconciliation configuration
+RECONCILIATION_DRY_RUN = False  # if True, the plans are only logged
+RECONCILIATION_BATCH_SIZE = 50
+RECONCILIATION_MAX_ADDS = 50  # limit risk in case of problem with analytics report, next ones on the next run
+RECONCILIATION_MAX_REMOVALS = 20  # limit risk in case of problem with analytics report, next ones on the next run
+
+# Retry configuration of failed Alma operations
+RETRY_IN_RUN_ATTEMPTS = 3  # attempts of an operation in the same run
+RETRY_IN_RUN_BACKOFF = 2  # seconds before the second attempt, doubled after each attempt
+RETRY_QUEUE_BACKOFF = 6  # hours before the next run may retry, doubled after each failed run
+RETRY_QUEUE_MAX_BACKOFF = 168  # hours
+RETRY_QUEUE_MAX_ATTEMPTS = 8  # failed runs before the operation is moved to the dead letter file
+RETRY_MAX_ABORTED_CALLS = 3  # consecutive operations aborted by almapiwrapper before pausing the API calls
+RETRY_ABORTED_PAUSE = 3600  # seconds without API calls after that, failed operations go to the retry queue
+
 # Email configuration
 REPORT_DESTINATION = 'raphael.rey@slsp.ch'
\ No newline at end of file
@@ -48,7 +48,8 @@
 #    last name and birth date (skip already updated users and
 #    multi matches -> "skkiped" column True)
 # 2. Update the user with the new CUG if a match is found
-# 3. Update the "Verwaltung" CUG using Analytics list
+# 3. Reconcile the "Mediotheken" and "Verwaltung" CUGs using
+#    one Analytics snapshot (see "CUG suppressing")
 # 4. Encrypt and push the data to the repository
 #
 # How to prevent processing one user?
@@ -56,65 +57,33 @@
 # - Option 1: remove the user of the source list
 # - Option 2: update the source list and set the flag "skipped" to True
 #
+# Daemon mode:
+# ------------
+# Started with the "--daemon" option, the script doesn't exit after the
+# run. It keeps the repository, the current state table and the API keys
+# in memory and runs a new cycle every SCHEDULER_INTERVAL seconds.
+# The first cycle of each day is a full run, the other cycles only
+# process the new users of the source list.
+#
 # CUG suppressing:
 # ----------------
-# NOT ACTIVE YET
-
-# Import libraries
-import logging
-from datetime import datetime
-import os
-import dotenv
-import config
-import update_cug.tools as tools
-from update_cug.gitrepo import GitRepo
-
-from update_cug import update_mediotheken, update_verwaltung
-
-# Set current active directory to the script directory
-os.chdir(
-    os.path.dirname(
-        os.path.abspath(__file__)
-    )
-)
-
-# Load environment variables with secrets to
-# access the git repository and to decrypt the data
-dotenv.load_dotenv()
-os.environ['GIT_SSL_NO_VERIFY'] = 'true'
-
-repo = GitRepo(
-    local_path=config.REPOSITORY_PATH,
-    remote_url=config.REPOSITORY_URL,
-    token_key=config.REPOSITORY_TOKEN_KEY,
-    access_token=os.getenv('abn_slsp_exchange_access')
-)
+# The reconciliation builds the desired members of each CUG (matched
+# users of the current state table, users with an "ag.ch" email
+# address) and the actual members from the Analytics snapshot
+# MEMBERSHIP_ANALYTICS_REPORT_PATH. Missing users receive the CUG,
+# users who should not have it anymore are reverted to the user group
+# of their NZ account. Skipped and HFGS users are never reverted.
+# Safety limits: RECONCILIATION_MAX_ADDS, RECONCILIATION_MAX_REMOVALS.
+# Preview: "python3 -m update_cug run-workflow reconciliation --dry-run"
 
-repo.clone_repo()
-
-log_file_path = tools.configure_logger()
-logging.info(f'Starting process at {datetime.now()}')
-
-# Update CUGs of users
-reports = list()
-reports.append(update_mediotheken.workflow())
-reports.append(update_verwaltung.workflow())
-
-tools.send_report(reports)
-
-logging.info(f'Process ended at {datetime.now()}')
-
-# Encrypt the data
-encrypted_log_file_path = tools.encrypt_log_file(log_file_path)
-tools.close_loggers()
+# Entry point:
+# ------------
+# This script is kept for the cron table, it is equivalent to
+# "python3 -m update_cug run". See "python3 -m update_cug --help"
+# for the other commands.
 
-# Push repository to remote
-repo.push_repo([
-                config.PATH_TO_DATA_CURRENT_STATE,
-                encrypted_log_file_path,
-                config.PATH_TO_REPORT_MEDIOTHEKEN,
-                config.PATH_TO_REPORT_VERWALTUNG
-                ])
+import sys
+from update_cug import cli
 
-# Remove the local repository
-repo.delete_local_repo()
+if __name__ == '__main__':
+    cli.main(['run'] + sys.argv[1:])
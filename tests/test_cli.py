@@ -0,0 +1,50 @@
+import os
+import pytest
+from cryptography.fernet import Fernet
+import config
+from update_cug import cli
+from update_cug.retry_queue import RetryQueue
+
+
+@pytest.fixture
+def lock_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'REPOSITORY_LOCK_PATH', str(tmp_path / 'repo.lock'))
+    return config.REPOSITORY_LOCK_PATH
+
+
+def test_repository_lock(lock_path):
+    with cli.repository_lock():
+        with open(lock_path) as f:
+            assert f.read() == str(os.getpid())
+
+        # A one-shot command doesn't remove the clone of the daemon
+        with pytest.raises(SystemExit):
+            with cli.repository_lock():
+                pass
+
+    assert not os.path.exists(lock_path)
+
+
+@pytest.mark.skipif(os.name != 'posix', reason='processes only checked on POSIX systems')
+def test_lock_of_stopped_process_is_taken_over(lock_path):
+    with open(lock_path, 'w') as f:
+        f.write('999999999')
+
+    with cli.repository_lock():
+        with open(lock_path) as f:
+            assert f.read() == str(os.getpid())
+
+
+def test_list_dead_letter(tmp_path, monkeypatch, capsys):
+    monkeypatch.setenv('abn_slsp_exchange_secret', Fernet.generate_key().decode())
+    monkeypatch.setattr(config, 'PATH_TO_RETRY_DEAD_LETTER', str(tmp_path / 'dead_letter.csv'))
+    queue = RetryQueue(str(tmp_path / 'queue.csv'), config.PATH_TO_RETRY_DEAD_LETTER)
+    queue.record_failure('reconciliation', 'CUG|remove|u1', 'get', 'HTTP 400: user not found')
+    queue.record_failure('mediotheken', 'row', 'search', 'HTTP 400: invalid query')
+    queue.save()
+
+    cli.command_dead_letter(cli.build_parser().parse_args(['dead-letter', '--workflow', 'reconciliation']))
+
+    output = capsys.readouterr().out.splitlines()
+    assert output[0].startswith('reconciliation CUG|remove|u1: get failed 1 times')
+    assert output[-1] == '1 entries in dead letter'
@@ -0,0 +1,26 @@
+import shutil
+import git
+from update_cug.gitrepo import GitRepo
+
+
+def test_pull_repo_clones_removed_repository(tmp_path, monkeypatch):
+    local_path = str(tmp_path / 'repo')
+    git.Repo.init(local_path).create_remote('origin', 'https://example.org/repo.git')
+    repo = GitRepo(local_path, 'example.org/repo.git', 'token', 'secret')
+    clones = []
+    monkeypatch.setattr(GitRepo, 'clone_repo', lambda self: clones.append(self.local_path))
+
+    assert repo.has_remote() is True
+
+    # Removed by a one-shot command using the same directory
+    shutil.rmtree(local_path)
+    repo.pull_repo()
+
+    assert repo.has_remote() is False
+    assert clones == [local_path]
+
+    # Cloned again without remote
+    git.Repo.init(local_path)
+    repo.pull_repo()
+
+    assert clones == [local_path, local_path]
@@ -0,0 +1,24 @@
+import logging
+from update_cug.http_session import PooledSession
+
+
+class Pool:
+    def __init__(self, host, num_requests, num_connections):
+        self.host = host
+        self.num_requests = num_requests
+        self.num_connections = num_connections
+
+
+def test_log_stats_since_last_log(caplog):
+    session = PooledSession(1)
+    pool = Pool('api-eu.hosted.exlibrisgroup.com', 10, 1)
+    session.session.get_adapter('https://').poolmanager.pools['alma'] = pool
+    session.stats[pool.host].update({'responses': 10, 'wire_bytes': 100, 'content_bytes': 400})
+
+    with caplog.at_level(logging.INFO):
+        session.log_stats()
+        pool.num_requests, pool.num_connections = 14, 2
+        session.log_stats()
+
+    assert '10 requests, 1 connections opened (90% reused), 100 bytes received for 400' in caplog.messages[0]
+    assert '4 requests, 1 connections opened (75% reused), 0 bytes received for 0' in caplog.messages[1]
@@ -0,0 +1,111 @@
+import pandas as pd
+import pytest
+import config
+from update_cug import alma, matching
+
+
+def make_state(rows):
+    df = pd.DataFrame(rows, columns=['last_name', 'first_name'])
+    df['birth_date'] = pd.to_datetime('2000-01-01')
+    return df
+
+
+class FakeAlma:
+    """Users search matching the words of the names without accents, like the API"""
+    def __init__(self, users):
+        self.users = users
+        self.queries = []
+
+    def search_users(self, q, zone=config.IZ, max_pages=None):
+        self.queries.append(q)
+        criteria = dict(part.split('~') for part in q.split(' and '))
+        users = [user for user in self.users
+                 if all(value in matching.normalize_names(pd.Series([user[field]]), transliterate=False)[0].split()
+                        for field, value in criteria.items())]
+        if max_pages is not None and len(users) > max_pages * alma.SEARCH_PAGE_SIZE:
+            return None, None
+        return users, None
+
+
+@pytest.fixture
+def fake_alma(monkeypatch):
+    fake = FakeAlma([{'primary_id': '1@eduid.ch', 'last_name': 'Müller', 'first_name': 'Hans'},
+                     {'primary_id': '2@eduid.ch', 'last_name': 'Müller-Meier', 'first_name': 'Anna Maria'},
+                     {'primary_id': '3@eduid.ch', 'last_name': 'Mueller', 'first_name': 'Peter'},
+                     {'primary_id': '4', 'last_name': 'Müller', 'first_name': 'Hans'}])
+    monkeypatch.setattr(alma, 'search_users', fake.search_users)
+    return fake
+
+
+def test_get_search_terms():
+    keys = matching.get_match_keys(make_state([('Müller-Meier', 'Hans'), ('Mueller', 'Hans'), ('Doe', 'Samuel')]))
+
+    assert matching.get_search_terms(keys.loc[0], 'last_name') == ['mueller', 'muller']
+    assert matching.get_row_queries(keys.loc[0]) == ['last_name~mueller and first_name~hans',
+                                                     'last_name~muller and first_name~hans']
+
+    # The transliteration is only reverted in names with umlauts
+    assert matching.get_search_terms(keys.loc[1], 'last_name') == ['mueller']
+    assert matching.get_row_queries(keys.loc[2]) == ['last_name~doe and first_name~samuel']
+
+
+def test_row_search_finds_other_spellings(fake_alma):
+    keys = matching.get_match_keys(make_state([('Müller', 'Hans'), ('Müller Meier', 'Anna'), ('Müller', 'Peter')]))
+    search = matching.CandidateSearch()
+    search.add_rows(keys)
+
+    assert search.get_candidates(keys.loc[0]) == (['1@eduid.ch'], None)
+    assert search.get_candidates(keys.loc[1]) == (['2@eduid.ch'], None)
+    assert search.get_candidates(keys.loc[2]) == (['3@eduid.ch'], None)
+
+
+def test_row_search_of_identical_rows(fake_alma):
+    fake_alma.users.append({'primary_id': '5@eduid.ch', 'last_name': 'Doe', 'first_name': 'John'})
+    keys = matching.get_match_keys(make_state([('Doe', 'John'), ('Doe', 'John')]))
+    search = matching.CandidateSearch()
+    search.add_rows(keys)
+
+    assert [search.get_candidates(row_keys) for _, row_keys in keys.iterrows()] == [(['5@eduid.ch'], None),
+                                                                                    (['5@eduid.ch'], None)]
+    assert fake_alma.queries == ['last_name~doe and first_name~john']
+    assert search.row_searches == dict()
+
+
+def test_block_search(fake_alma):
+    keys = matching.get_match_keys(make_state([('Mueller', 'Hans'), ('Müller', 'Peter'), ('Müller', 'Anna')]))
+    search = matching.CandidateSearch()
+    search.add_rows(keys)
+
+    assert [search.get_candidates(row_keys) for _, row_keys in keys.iterrows()] == [(['1@eduid.ch'], None),
+                                                            (['3@eduid.ch'], None),
+                                                            (['2@eduid.ch'], None)]
+    assert fake_alma.queries == ['last_name~mueller', 'last_name~muller']
+
+    # The block is dropped after its last row
+    assert search.block_searches == dict()
+    assert search.nb_block_searches == 1
+
+
+def test_block_with_too_many_results(fake_alma):
+    fake_alma.users += [{'primary_id': f'{j}@eduid.ch', 'last_name': 'Muller', 'first_name': 'Eva'}
+                        for j in range(10, 10 + 6 * alma.SEARCH_PAGE_SIZE)]
+    keys = matching.get_match_keys(make_state([('Müller', 'Hans'), ('Müller', 'Peter'), ('Müller', 'Anna')]))
+    search = matching.CandidateSearch()
+    search.add_rows(keys)
+
+    assert search.get_candidates(keys.loc[0]) == (['1@eduid.ch'], None)
+    assert search.block_searches['mueller'] == (None, None)
+    assert fake_alma.queries[-2:] == ['last_name~mueller and first_name~hans',
+                                      'last_name~muller and first_name~hans']
+
+
+def test_blocks_across_chunks(fake_alma):
+    keys = matching.get_match_keys(make_state([('Mueller', 'Hans'), ('Müller', 'Peter'), ('Müller', 'Anna')]))
+    search = matching.CandidateSearch()
+    for chunk in [keys.loc[[0, 1]], keys.loc[[2]]]:
+        search.add_rows(chunk)
+
+    assert [search.get_candidates(row_keys) for _, row_keys in keys.iterrows()] == [(['1@eduid.ch'], None),
+                                                                                    (['3@eduid.ch'], None),
+                                                                                    (['2@eduid.ch'], None)]
+    assert fake_alma.queries == ['last_name~mueller', 'last_name~muller']
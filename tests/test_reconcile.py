@@ -0,0 +1,228 @@
+import os
+import pandas as pd
+import pytest
+from cryptography.fernet import Fernet
+import config
+from update_cug import reconcile, tools, update_mediotheken, update_verwaltung
+from update_cug.retry_queue import RetryQueue
+
+MEDIOTHEK = config.MEDIOTHEK_USER_GROUP_CODE
+VERWALTUNG = config.VERWALTUNG_USER_GROUP_CODE
+HFGS = config.HFGS_USER_GROUP_CODE
+
+
+def make_snapshot(rows):
+    return pd.DataFrame(rows, columns=['primary_id', 'user_group', 'email'])
+
+
+def make_current_state(rows):
+    return pd.DataFrame(rows, columns=['primary_id', 'skipped'])
+
+
+@pytest.fixture
+def snapshot():
+    return make_snapshot([
+        ('m_ok', MEDIOTHEK, ''),               # matched Mediothek user with the CUG
+        ('m_old', MEDIOTHEK, ''),              # not in the Mediotheken list anymore
+        ('m_manual', MEDIOTHEK, ''),           # CUG given by hand, row skipped without primary ID
+        ('m_skipped', MEDIOTHEK, ''),          # skipped in the current state table
+        ('m_new', 'ABN_Patron', ''),           # matched Mediothek user without the CUG
+        ('v_ok', VERWALTUNG, 'a@ag.ch'),       # Verwaltung user with the CUG
+        ('v_new', 'ABN_Patron', 'b@dfr.ag.ch'),  # Verwaltung user without the CUG
+        ('v_old', VERWALTUNG, 'c@example.ch'),  # not ag.ch anymore
+        ('both', VERWALTUNG, 'd@ag.ch'),       # ag.ch and in the Mediotheken list
+        ('hfgs', HFGS, 'e@ag.ch'),             # HFGS users never get the Verwaltung CUG
+    ])
+
+
+@pytest.fixture
+def current_state():
+    return make_current_state([
+        ('m_ok', False),
+        ('m_skipped', True),
+        ('m_new', False),
+        ('both', False),
+        ('', False),
+    ])
+
+
+def test_verwaltung_desired_members(snapshot):
+    assert update_verwaltung.get_desired_members(snapshot) == {'v_ok', 'v_new', 'both'}
+
+
+def test_desired_membership_priority(snapshot, current_state):
+    desired = reconcile.build_desired_membership(snapshot, current_state)
+
+    assert desired[MEDIOTHEK] == {'m_ok', 'm_new', 'both'}
+    assert desired[VERWALTUNG] == {'v_ok', 'v_new'}
+
+
+def test_desired_membership_without_current_state(snapshot):
+    desired = reconcile.build_desired_membership(snapshot, None)
+
+    # Actual Mediothek members keep their CUG and are not moved to the Verwaltung CUG
+    assert MEDIOTHEK not in desired
+    assert desired[VERWALTUNG] == {'v_ok', 'v_new', 'both'}
+
+
+def test_actual_membership(snapshot):
+    actual = reconcile.build_actual_membership(snapshot)
+
+    assert actual[MEDIOTHEK] == {'m_ok', 'm_old', 'm_manual', 'm_skipped'}
+    assert actual[VERWALTUNG] == {'v_ok', 'v_old', 'both'}
+
+
+def test_protected_members(snapshot, current_state):
+    assert reconcile.build_protected_members(snapshot, current_state) == {'hfgs', 'm_skipped'}
+    assert reconcile.build_protected_members(snapshot, None) == {'hfgs'}
+
+
+def test_plans(snapshot, current_state):
+    desired = reconcile.build_desired_membership(snapshot, current_state)
+    actual = reconcile.build_actual_membership(snapshot)
+    protected = reconcile.build_protected_members(snapshot, current_state)
+
+    # Only the matched users who left the list are removed
+    assert reconcile.build_plans(MEDIOTHEK, desired, actual, protected, {'m_old'}) == (['both', 'm_new'], ['m_old'])
+    assert reconcile.build_plans(MEDIOTHEK, desired, actual, protected, set()) == (['both', 'm_new'], [])
+
+    # "both" moves to the Mediothek CUG with the add plan of this CUG, it is not removed
+    assert reconcile.build_plans(VERWALTUNG, desired, actual, protected) == (['v_new'], ['v_old'])
+
+
+def test_plans_without_current_state(snapshot):
+    desired = reconcile.build_desired_membership(snapshot, None)
+    actual = reconcile.build_actual_membership(snapshot)
+    protected = reconcile.build_protected_members(snapshot, None)
+
+    assert reconcile.build_plans(VERWALTUNG, desired, actual, protected) == (['v_new'], ['v_old'])
+
+
+@pytest.fixture
+def repository(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'PATH_TO_DATA_CURRENT_STATE', str(tmp_path / 'state.csv'))
+    monkeypatch.setattr(config, 'PATH_TO_REPORT_RECONCILIATION', str(tmp_path / 'reconciliation.csv'))
+    monkeypatch.setattr(config, 'PATH_TO_REPORT_VERWALTUNG', str(tmp_path / 'verwaltung.csv'))
+    monkeypatch.setattr(config, 'PATH_TO_RETRY_QUEUE', str(tmp_path / 'queue.csv'))
+    monkeypatch.setattr(config, 'PATH_TO_RETRY_DEAD_LETTER', str(tmp_path / 'dead_letter.csv'))
+    monkeypatch.setattr(config, 'PATH_TO_DEPARTED_MEMBERS', str(tmp_path / 'departed.csv'))
+    monkeypatch.setenv('abn_slsp_exchange_secret', Fernet.generate_key().decode())
+    return tmp_path
+
+
+def test_dry_run_writes_nothing(repository, snapshot, monkeypatch):
+    monkeypatch.setattr(reconcile, 'fetch_membership_snapshot', lambda: snapshot)
+
+    report = reconcile.workflow(dry_run=True, retry_queue=RetryQueue(str(repository / 'queue.csv'),
+                                                                     str(repository / 'dead_letter.csv')))
+
+    assert report is None
+    assert os.listdir(repository) == []
+
+
+def test_verwaltung_fallback_without_snapshot(repository, monkeypatch):
+    monkeypatch.setattr(reconcile, 'fetch_membership_snapshot', lambda: None)
+    monkeypatch.setattr(update_verwaltung, 'fetch_analytics_report', lambda: ['v2', 'v1', 'v1'])
+    added = list()
+    monkeypatch.setattr(reconcile, 'add_user_group',
+                        lambda primary_id, cug_code, retry_queue: added.append((primary_id, cug_code)) is None)
+    monkeypatch.setattr(reconcile, 'remove_user_group', lambda *_: pytest.fail('no user must be removed'))
+    monkeypatch.setattr(RetryQueue, 'save', lambda self: None)
+
+    reconcile.workflow(retry_queue=RetryQueue(str(repository / 'queue.csv'), str(repository / 'dead_letter.csv')))
+
+    assert added == [('v1', VERWALTUNG), ('v2', VERWALTUNG)]
+    report = pd.read_csv(config.PATH_TO_REPORT_RECONCILIATION, dtype=reconcile.REPORT_DTYPES)
+    assert report['nb_added'].tolist() == [2]
+    assert report['nb_desired'].isna().all()
+
+
+def test_remaining_departed(snapshot, current_state):
+    desired = reconcile.build_desired_membership(snapshot, current_state)
+    actual = reconcile.build_actual_membership(snapshot)
+    protected = reconcile.build_protected_members(snapshot, current_state)
+    departed = {'m_old', 'm_ok', 'm_skipped', 'gone', 'm_manual'}
+
+    # Back in the list, protected and without the CUG are dropped, the removed ones too
+    assert reconcile.build_remaining_departed(departed, desired, actual, protected, []) == {'m_old', 'm_manual'}
+    assert reconcile.build_remaining_departed(departed, desired, actual, protected, ['m_old']) == {'m_manual'}
+
+
+def test_removals_are_capped(monkeypatch):
+    monkeypatch.setattr(config, 'RECONCILIATION_MAX_REMOVALS', 2)
+
+    result = reconcile.apply_plans(MEDIOTHEK, [], ['r1', 'r2', 'r3'], True, None)
+
+    assert result['removed'] == ['r1', 'r2']
+
+
+def test_snapshot_with_several_email_columns():
+    data = pd.DataFrame([('u1', VERWALTUNG, 'a@example.ch', 'a@ag.ch'),
+                         ('u2', 'ABN_Patron', 'b@example.ch', None)],
+                        columns=['Primary Identifier', 'User Group Code', 'Preferred Email', 'Email Address'])
+
+    snapshot = reconcile.build_snapshot(data)
+
+    assert len(snapshot) == 4
+    assert update_verwaltung.get_desired_members(snapshot) == {'u1'}
+
+
+def test_has_ag_ch_email():
+    assert update_verwaltung.has_ag_ch_email({'contact_info': {'email': [{'email_address': 'a@example.ch'},
+                                                                         {'email_address': 'A@dfr.AG.ch'}]}})
+    assert not update_verwaltung.has_ag_ch_email({'contact_info': {'email': [{'email_address': 'a@bag.ch'}]}})
+    assert not update_verwaltung.has_ag_ch_email({})
+
+
+def make_state_table(rows):
+    df = pd.DataFrame(rows, columns=['last_name', 'first_name', 'primary_id', 'skipped'])
+    df['birth_date'] = '2000-01-01'
+    df['barcode'] = ''
+    df['barcode_added'] = False
+    df['cug_updated'] = df['primary_id'] != ''
+    df['message'] = ''
+    return df[update_mediotheken.STATE_KEY_COLUMNS + update_mediotheken.STATE_COLUMNS]
+
+
+def test_departed_members_recorded_on_save(repository, monkeypatch):
+    tools.encrypt_data(make_state_table([('A', 'a', 'm_old', False), ('B', 'b', 'm_ok', False),
+                                         ('C', 'c', 'm_skipped', True), ('D', 'd', '', True)]),
+                       config.PATH_TO_DATA_CURRENT_STATE)
+    monkeypatch.setattr(update_mediotheken, 'update_report', lambda counts: '')
+
+    # Rows of m_old and of the skipped users left the list
+    update_mediotheken.save_current_state(
+        update_mediotheken.clean_current_state_table_col_types(make_state_table([('B', 'b', 'm_ok', False)])))
+
+    assert update_mediotheken.load_departed_members() == {'m_old'}
+
+
+def test_only_departed_members_removed(repository, snapshot, monkeypatch):
+    # Multi match row: skipped without primary ID, the CUG of m_manual was given by hand
+    tools.encrypt_data(make_state_table([('A', 'a', 'm_ok', False), ('B', 'b', 'm_skipped', True),
+                                         ('C', 'c', 'm_new', False), ('D', 'd', 'both', False),
+                                         ('E', 'e', '', True)]),
+                       config.PATH_TO_DATA_CURRENT_STATE)
+    update_mediotheken.save_departed_members({'m_old'})
+    monkeypatch.setattr(reconcile, 'fetch_membership_snapshot', lambda: snapshot)
+    monkeypatch.setattr(reconcile, 'add_user_group', lambda *_: True)
+    removed = list()
+    monkeypatch.setattr(reconcile, 'remove_user_group',
+                        lambda primary_id, cug_code, retry_queue: removed.append((primary_id, cug_code)) is None)
+
+    reconcile.workflow(retry_queue=RetryQueue(str(repository / 'queue.csv'), str(repository / 'dead_letter.csv')))
+
+    assert removed == [('m_old', MEDIOTHEK), ('v_old', VERWALTUNG)]
+    assert update_mediotheken.load_departed_members() == set()
+
+
+def test_failed_operation_only_blocks_same_cug_and_operation(repository, monkeypatch):
+    retry_queue = RetryQueue(str(repository / 'queue.csv'), str(repository / 'dead_letter.csv'))
+    monkeypatch.setattr(reconcile.alma, 'fetch_user', lambda primary_id, zone='IZ': (None, 'HTTP 400: not found'))
+
+    assert reconcile.remove_user_group('u1', MEDIOTHEK, retry_queue) is False
+
+    assert reconcile.filter_eligible(MEDIOTHEK, reconcile.REMOVE, ['u1'], retry_queue) == []
+    assert reconcile.filter_eligible(MEDIOTHEK, reconcile.ADD, ['u1'], retry_queue) == ['u1']
+    assert reconcile.filter_eligible(VERWALTUNG, reconcile.ADD, ['u1'], retry_queue) == ['u1']
+    assert retry_queue.dead_letter['key'].tolist() == [f'{MEDIOTHEK}|remove|u1']
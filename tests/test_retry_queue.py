@@ -0,0 +1,85 @@
+import pytest
+from cryptography.fernet import Fernet
+import config
+from update_cug import alma
+from update_cug.retry_queue import PERMANENT, TRANSIENT, RetryQueue, classify_error
+
+
+@pytest.fixture
+def secret(monkeypatch):
+    monkeypatch.setenv('abn_slsp_exchange_secret', Fernet.generate_key().decode())
+
+
+@pytest.fixture
+def no_pause(monkeypatch):
+    monkeypatch.setattr(alma, '_nb_aborted_calls', 0)
+    monkeypatch.setattr(alma, '_paused_until', 0.0)
+    monkeypatch.setattr(alma.time, 'sleep', lambda delay: None)
+
+
+def test_load_keeps_keys_as_strings(tmp_path, secret):
+    queue = RetryQueue(str(tmp_path / 'queue'), str(tmp_path / 'dead_letter'))
+    queue.record_failure('verwaltung', '00042', 'put', 'HTTP 500: internal server error')
+    queue.save()
+
+    queue = RetryQueue(str(tmp_path / 'queue'), str(tmp_path / 'dead_letter'))
+
+    assert queue.queue['key'].tolist() == ['00042']
+    assert queue.queue['attempts'].tolist() == [1]
+    assert queue.is_eligible('verwaltung', '00042') is False
+
+    queue.record_failure('verwaltung', '00042', 'put', 'HTTP 500: internal server error')
+    assert queue.queue['attempts'].tolist() == [2]
+
+
+def test_classify_error():
+    assert classify_error('no response: API call aborted') == TRANSIENT
+    assert classify_error('HTTP 503: service unavailable') == TRANSIENT
+    assert classify_error('HTTP 400: user not found') == PERMANENT
+
+
+def test_retry_in_run_turns_exit_into_transient_error(no_pause):
+    calls = []
+
+    def call():
+        calls.append(1)
+        if len(calls) < 2:
+            raise SystemExit(1)
+        return 'user', None
+
+    assert alma.retry_in_run(call, 'default') == ('user', None)
+    assert len(calls) == 2
+
+
+def test_retry_in_run_pauses_after_aborted_calls(no_pause):
+    calls = []
+
+    def call():
+        calls.append(1)
+        raise SystemExit(1)
+
+    result, error_msg = alma.retry_in_run(call, 'default')
+    assert result == 'default'
+    assert classify_error(error_msg) == TRANSIENT
+    assert len(calls) == config.RETRY_MAX_ABORTED_CALLS
+
+    # No API call during the pause
+    result, error_msg = alma.retry_in_run(call, 'default')
+    assert result == 'default'
+    assert 'paused' in error_msg
+    assert len(calls) == config.RETRY_MAX_ABORTED_CALLS
+
+
+def test_requeue_dead_letter(tmp_path, secret):
+    queue = RetryQueue(str(tmp_path / 'queue'), str(tmp_path / 'dead_letter'))
+    queue.record_failure('reconciliation', 'CUG|remove|u1', 'get', 'HTTP 400: user not found')
+    queue.record_failure('reconciliation', 'CUG|add|u2', 'put', 'HTTP 400: invalid user group')
+    queue.record_failure('mediotheken', 'row', 'search', 'HTTP 400: invalid query')
+
+    assert queue.requeue('reconciliation', 'CUG|remove|u1') == 1
+    assert queue.is_eligible('reconciliation', 'CUG|remove|u1') is True
+    assert queue.queue['attempts'].tolist() == [0]
+
+    assert queue.requeue() == 2
+    assert len(queue.dead_letter) == 0
+    assert queue.is_eligible('mediotheken', 'row') is True
@@ -0,0 +1,130 @@
+from functools import partial
+import pandas as pd
+import pytest
+from cryptography.fernet import Fernet
+import config
+from update_cug import scheduler, tools, update_mediotheken
+from update_cug.retry_queue import RetryQueue
+
+SOURCE_COLUMNS = ['Name', 'Vorname', 'Geburtsdatum', 'Barcode']
+
+
+def make_source(rows):
+    return pd.DataFrame([(f'Name{i}', f'Vorname{i}', '2000-01-01', f'{i:05d}') for i in rows], columns=SOURCE_COLUMNS)
+
+
+def make_state(rows, cug_updated=True):
+    df = make_source(rows)
+    df.columns = update_mediotheken.STATE_KEY_COLUMNS
+    df['primary_id'] = [f'{i}@eduid.ch' if cug_updated else '' for i in rows]
+    df['barcode_added'] = cug_updated
+    df['cug_updated'] = cug_updated
+    df['skipped'] = False
+    df['message'] = ''
+    return df
+
+
+class FakeRepo:
+    """Repository already cloned, other processes can change its files when it is pulled"""
+    def __init__(self):
+        self.changes = []
+        self.pushed = []
+
+    def pull_repo(self):
+        while len(self.changes) > 0:
+            self.changes.pop(0)()
+
+    def push_repo(self, files_to_commit, files_to_remove=None):
+        self.pushed.append(files_to_commit)
+
+    def delete_local_repo(self):
+        pass
+
+
+@pytest.fixture
+def repository(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'REPOSITORY_PATH', str(tmp_path))
+    for name in ['PATH_TO_SOURCE_DATA', 'PATH_TO_DATA_CURRENT_STATE', 'PATH_TO_DEPARTED_MEMBERS',
+                 'PATH_TO_RETRY_QUEUE', 'PATH_TO_RETRY_DEAD_LETTER']:
+        monkeypatch.setattr(config, name, str(tmp_path / f'{name.lower()}.csv'))
+    monkeypatch.setenv('abn_slsp_exchange_secret', Fernet.generate_key().decode())
+    monkeypatch.setattr(scheduler, 'RetryQueue',
+                        partial(RetryQueue, config.PATH_TO_RETRY_QUEUE, config.PATH_TO_RETRY_DEAD_LETTER))
+
+    # No API call, no report sent
+    monkeypatch.setattr(scheduler.http_session, 'install_session', lambda: None)
+    monkeypatch.setattr(scheduler.crypto, 'encrypt_log_file', lambda log_file_path: f'{log_file_path}.enc')
+    monkeypatch.setattr(scheduler.tools, 'send_report', lambda reports: None)
+    monkeypatch.setattr(update_mediotheken, 'update_report', lambda counts: 'mediotheken')
+
+    tools.encrypt_data(make_source([0, 1]), config.PATH_TO_SOURCE_DATA)
+    tools.encrypt_data(make_state([0, 1]), config.PATH_TO_DATA_CURRENT_STATE)
+    return tmp_path
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    calls = {'process_users': [], 'reconcile': []}
+
+    def process_users(df, retry_queue, indexes=None):
+        calls['process_users'].append((df.copy(), indexes))
+
+    monkeypatch.setattr(update_mediotheken, 'process_users', process_users)
+    monkeypatch.setattr(scheduler.reconcile, 'workflow',
+                        lambda retry_queue: calls['reconcile'].append(retry_queue) or 'reconciliation')
+    return calls
+
+
+def test_full_then_incremental_cycle(repository, calls):
+    repo = FakeRepo()
+    cycles = scheduler.Scheduler(repo, 0)
+
+    # First cycle of the day: all the rows and the reconciliation
+    cycles.run_cycle()
+    assert [indexes for _, indexes in calls['process_users']] == [None]
+    assert len(calls['reconcile']) == 1
+
+    # Next cycles: only the new rows of the source list
+    repo.changes.append(lambda: tools.encrypt_data(make_source([0, 1, 2]), config.PATH_TO_SOURCE_DATA))
+    cycles.run_cycle()
+    assert [indexes for _, indexes in calls['process_users']] == [None, [2]]
+    assert len(calls['reconcile']) == 1
+    assert config.PATH_TO_DATA_CURRENT_STATE in repo.pushed[-1]
+
+
+def test_unchanged_source_skipped(repository, calls):
+    repo = FakeRepo()
+    cycles = scheduler.Scheduler(repo, 0)
+    cycles.run_cycle()
+
+    cycles.run_cycle()
+
+    assert len(calls['process_users']) == 1
+    assert len(calls['reconcile']) == 1
+
+    # Only the encrypted log is pushed
+    assert len(repo.pushed[-1]) == 1 and repo.pushed[-1][0].endswith('.enc')
+
+
+def test_changed_files_loaded_again(repository, calls):
+    repo = FakeRepo()
+    cycles = scheduler.Scheduler(repo, 0)
+    cycles.run_cycle()
+    retry_queue = cycles.retry_queue
+
+    # Reset of the current state table and new retry queue pushed by other processes
+    def reset():
+        tools.encrypt_data(make_state([0, 1], cug_updated=False), config.PATH_TO_DATA_CURRENT_STATE)
+        tools.encrypt_data(make_source([0, 1, 2]), config.PATH_TO_SOURCE_DATA)
+        other_queue = RetryQueue(config.PATH_TO_RETRY_QUEUE, config.PATH_TO_RETRY_DEAD_LETTER)
+        other_queue.record_failure(update_mediotheken.RETRY_WORKFLOW, 'key', 'get', 'HTTP 500: error')
+        other_queue.save()
+
+    repo.changes.append(reset)
+    cycles.run_cycle()
+
+    df, indexes = calls['process_users'][-1]
+    assert indexes is None
+    assert df['cug_updated'].tolist() == [False, False, False]
+    assert cycles.retry_queue is not retry_queue
+    assert cycles.retry_queue.queue['key'].tolist() == ['key']
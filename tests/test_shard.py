@@ -0,0 +1,25 @@
+import pandas as pd
+import pytest
+from update_cug import matching, shard
+
+
+def test_run_shard_turns_exit_into_exception(monkeypatch):
+    def process_shard(index, nb_shards):
+        raise SystemExit(1)
+
+    monkeypatch.setattr(shard, 'process_shard', process_shard)
+
+    with pytest.raises(RuntimeError, match='shard 1 / 3 exited with code 1'):
+        shard.run_shard(1, 3)
+
+
+def test_rows_sharing_a_last_name_are_in_the_same_shard():
+    last_names = pd.Series(['Müller', 'Mueller', 'MÜLLER'])
+    row_keys = pd.Series(['Müller|Hans|2000-01-01|B1', 'Mueller|Anna|2000-01-02|', 'MÜLLER|Eva|2000-01-03|B3'])
+
+    shards = matching.normalize_names(last_names).map(lambda key: shard.get_shard(key, 7))
+    queue_shards = (matching.normalize_names(row_keys.str.split('|').str[0])
+                    .map(lambda key: shard.get_shard(key, 7)))
+
+    assert shards.nunique() == 1
+    assert queue_shards.tolist() == shards.tolist()
@@ -0,0 +1,64 @@
+import os
+import pandas as pd
+import pytest
+from cryptography.fernet import Fernet
+from update_cug import tools
+
+
+@pytest.fixture
+def secret(monkeypatch):
+    key = Fernet.generate_key()
+    monkeypatch.setenv('abn_slsp_exchange_secret', key.decode())
+    return Fernet(key)
+
+
+def make_table(nb_rows):
+    return pd.DataFrame({'barcode': [f'{i:05d}' for i in range(nb_rows)], 'name': [f'n{i}' for i in range(nb_rows)]})
+
+
+def test_encrypt_data_chunks_writes_one_token(tmp_path, secret):
+    file_path = str(tmp_path / 'table.csv')
+    df = make_table(5)
+
+    tools.encrypt_data_chunks([df.iloc[:2], df.iloc[2:4], df.iloc[4:]], file_path, list(df.columns))
+
+    # Decrypted at once like the files written by `encrypt_data`
+    with open(file_path, 'rb') as f:
+        assert secret.decrypt(f.read()) == df.to_csv(sep=';', index=False).encode()
+    assert os.listdir(tmp_path) == ['table.csv']
+
+
+def test_encrypt_data_chunks_without_chunk(tmp_path, secret):
+    file_path = str(tmp_path / 'table.csv')
+
+    tools.encrypt_data_chunks([], file_path, ['barcode', 'name'])
+
+    df = tools.decrypt_data(file_path, dtype=str)
+    assert len(df) == 0
+    assert list(df.columns) == ['barcode', 'name']
+
+
+def test_iter_decrypt_data_single_token(tmp_path, secret):
+    file_path = str(tmp_path / 'table.csv')
+    df = make_table(5)
+    tools.encrypt_data(df, file_path)
+
+    chunks = list(tools.iter_decrypt_data(file_path, 2, dtype=str))
+
+    assert [len(chunk) for chunk in chunks] == [2, 2, 1]
+    pd.testing.assert_frame_equal(pd.concat(chunks, ignore_index=True), df)
+
+
+def test_iter_decrypt_data_one_token_per_line(tmp_path, secret):
+    # Written by a previous version: later tokens have no header
+    file_path = str(tmp_path / 'table.csv')
+    df = make_table(5)
+    with open(file_path, 'wb') as f:
+        for i, chunk in enumerate([df.iloc[:3], df.iloc[3:]]):
+            f.write(secret.encrypt(chunk.to_csv(sep=';', index=False, header=(i == 0)).encode()) + b'\n')
+
+    chunks = list(tools.iter_decrypt_data(file_path, 2, dtype=str))
+
+    assert [len(chunk) for chunk in chunks] == [2, 2, 1]
+    pd.testing.assert_frame_equal(pd.concat(chunks, ignore_index=True), df)
+    pd.testing.assert_frame_equal(tools.decrypt_data(file_path, dtype=str), df)
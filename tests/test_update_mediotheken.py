@@ -0,0 +1,85 @@
+from functools import partial
+import pandas as pd
+import pytest
+from cryptography.fernet import Fernet
+import config
+from update_cug import alma, tools, update_mediotheken
+from update_cug.retry_queue import RetryQueue
+
+SOURCE_COLUMNS = ['Name', 'Vorname', 'Geburtsdatum', 'Barcode']
+
+
+def make_source(rows):
+    return pd.DataFrame([(f'Name{i}', f'Vorname{i}', '2000-01-01', f'{i:05d}') for i in rows], columns=SOURCE_COLUMNS)
+
+
+def make_state(rows):
+    df = make_source(rows)
+    df.columns = update_mediotheken.STATE_KEY_COLUMNS
+    df['primary_id'] = [f'{i}@eduid.ch' for i in rows]
+    df['barcode_added'] = True
+    df['cug_updated'] = True
+    df['skipped'] = False
+    df['message'] = ''
+    return df
+
+
+@pytest.fixture
+def repository(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'PATH_TO_SOURCE_DATA', str(tmp_path / 'source.csv'))
+    monkeypatch.setattr(config, 'PATH_TO_DATA_CURRENT_STATE', str(tmp_path / 'state.csv'))
+    monkeypatch.setattr(update_mediotheken, 'RetryQueue',
+                        partial(RetryQueue, str(tmp_path / 'queue.csv'), str(tmp_path / 'dead_letter.csv')))
+    monkeypatch.setattr(config, 'PATH_TO_DEPARTED_MEMBERS', str(tmp_path / 'departed.csv'))
+    monkeypatch.setattr(config, 'CHUNK_SIZE', 2)
+    monkeypatch.setenv('abn_slsp_exchange_secret', Fernet.generate_key().decode())
+    monkeypatch.setattr(update_mediotheken, 'update_report', lambda counts: '')
+
+    # No account matches the new rows
+    monkeypatch.setattr(alma, 'search_users', lambda q, zone=config.IZ, max_pages=None: ([], None))
+    return tmp_path
+
+
+def load_state():
+    return update_mediotheken.clean_current_state_table_col_types(
+        tools.decrypt_data(config.PATH_TO_DATA_CURRENT_STATE, dtype=update_mediotheken.STATE_DTYPES))
+
+
+def test_workflow_in_chunks(repository):
+    # Rows 1 and 3 left the list, rows 5 to 7 are new, rows 4 and 2 changed their order
+    tools.encrypt_data(make_state([0, 1, 2, 3, 4]), config.PATH_TO_DATA_CURRENT_STATE)
+    tools.encrypt_data(make_source([0, 4, 5, 2, 6, 7]), config.PATH_TO_SOURCE_DATA)
+
+    update_mediotheken.workflow()
+
+    df = load_state()
+    assert df['barcode'].tolist() == ['00000', '00004', '00005', '00002', '00006', '00007']
+    assert df['primary_id'].fillna('').tolist() == ['0@eduid.ch', '4@eduid.ch', '', '2@eduid.ch', '', '']
+    assert df['cug_updated'].tolist() == [True, True, False, True, False, False]
+    assert update_mediotheken.load_departed_members() == {'1@eduid.ch', '3@eduid.ch'}
+
+
+def test_workflow_without_current_state(repository):
+    tools.encrypt_data(make_source([0, 1, 2]), config.PATH_TO_SOURCE_DATA)
+
+    update_mediotheken.workflow()
+
+    df = load_state()
+    assert df['barcode'].tolist() == ['00000', '00001', '00002']
+    assert not df['cug_updated'].any()
+    assert update_mediotheken.load_departed_members() == set()
+
+
+def test_workflow_with_empty_source(repository):
+    tools.encrypt_data(make_state([0]), config.PATH_TO_DATA_CURRENT_STATE)
+    tools.encrypt_data(make_source([]), config.PATH_TO_SOURCE_DATA)
+
+    update_mediotheken.workflow()
+
+    df = load_state()
+    assert len(df) == 0
+    assert list(df.columns) == update_mediotheken.STATE_KEY_COLUMNS + update_mediotheken.STATE_COLUMNS
+    assert update_mediotheken.load_departed_members() == {'0@eduid.ch'}
+
+    # The next run reads the empty table
+    update_mediotheken.workflow()
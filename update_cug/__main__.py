@@ -0,0 +1,3 @@
+from update_cug import cli
+
+cli.main()
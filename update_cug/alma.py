@@ -0,0 +1,209 @@
+import logging
+import time
+from typing import Callable, Dict, List, Optional, Tuple, TypeVar
+from almapiwrapper.record import Record
+from almapiwrapper.users import User
+import config
+from update_cug.retry_queue import classify_error, TRANSIENT
+
+T = TypeVar('T')
+
+# Number of users returned by one request of a search
+SEARCH_PAGE_SIZE = 100
+
+# Number of consecutive operations aborted by almapiwrapper and end of the pause of the API calls
+_nb_aborted_calls = 0
+_paused_until = 0.0
+
+
+def is_paused() -> bool:
+    """Check if the API calls are paused after too many aborted operations
+
+    Returns
+    -------
+    bool
+        True if no API call must be done
+    """
+    return time.monotonic() < _paused_until
+
+
+def call_once(call: Callable[[], Tuple[T, Optional[str]]], default: T) -> Tuple[T, Optional[str]]:
+    """Run one attempt of an Alma operation
+
+    almapiwrapper exits the process after 3 network errors or when the number of remaining
+    API calls is low. The exit is turned into a transient error, so the failed operation is
+    stored in the retry queue and the run can save its state. After RETRY_MAX_ABORTED_CALLS
+    consecutive aborted operations, no API call is done during RETRY_ABORTED_PAUSE seconds.
+
+    Parameters
+    ----------
+    call: Callable[[], Tuple[T, Optional[str]]]
+        Operation returning its result and the error message, None if no error
+    default: T
+        Result returned if the operation is aborted
+
+    Returns
+    -------
+    Tuple[T, Optional[str]]
+        Result and error message of the operation
+    """
+    global _nb_aborted_calls, _paused_until
+
+    if is_paused():
+        return default, 'no response: API calls paused after aborted operations'
+
+    try:
+        result, error_msg = call()
+    except SystemExit:
+        _nb_aborted_calls += 1
+        if _nb_aborted_calls >= config.RETRY_MAX_ABORTED_CALLS:
+            logging.critical(f'{_nb_aborted_calls} operations aborted => API calls paused for '
+                             f'{config.RETRY_ABORTED_PAUSE} seconds')
+            _paused_until = time.monotonic() + config.RETRY_ABORTED_PAUSE
+        return default, 'no response: API call aborted'
+
+    _nb_aborted_calls = 0
+    return result, error_msg
+
+
+def retry_in_run(call: Callable[[], Tuple[T, Optional[str]]], default: T = None) -> Tuple[T, Optional[str]]:
+    """Run an Alma operation and retry it while it fails with a transient error
+
+    The operation is tried at most RETRY_IN_RUN_ATTEMPTS times, the delay between
+    two attempts starts with RETRY_IN_RUN_BACKOFF seconds and is doubled each time.
+
+    Parameters
+    ----------
+    call: Callable[[], Tuple[T, Optional[str]]]
+        Operation returning its result and the error message, None if no error
+    default: T
+        Result returned if the operation is aborted, see `call_once`
+
+    Returns
+    -------
+    Tuple[T, Optional[str]]
+        Result and error message of the last attempt
+    """
+    result, error_msg = call_once(call, default)
+
+    for attempt in range(1, config.RETRY_IN_RUN_ATTEMPTS):
+        if error_msg is None or classify_error(error_msg) != TRANSIENT or is_paused():
+            break
+
+        delay = config.RETRY_IN_RUN_BACKOFF * 2 ** (attempt - 1)
+        logging.warning(f'Transient error "{error_msg}", new attempt in {delay} seconds')
+        time.sleep(delay)
+        result, error_msg = call_once(call, default)
+
+    return result, error_msg
+
+
+def search_users(q: str, zone: str = config.IZ,
+                 max_pages: Optional[int] = None) -> Tuple[Optional[List[Dict]], Optional[str]]:
+    """Search users in the IZ according to a request
+
+    Unlike `almapiwrapper.users.fetch_users`, an error is not returned as an empty result and
+    the brief records of the search are returned, so candidates can be filtered by name
+    before fetching their full data.
+
+    Parameters
+    ----------
+    q: str
+        Request in API syntax
+    zone: str
+        Code of the IZ
+    max_pages: int, optional
+        Maximum number of requests of the search, the other pages are not fetched if the
+        search has more results
+
+    Returns
+    -------
+    Tuple[Optional[List[Dict]], Optional[str]]
+        List of brief records of the found users and error message, None if no error. No
+        users and no error if the search needs more than `max_pages` requests
+    """
+    def call() -> Tuple[Optional[List[Dict]], Optional[str]]:
+        users = []
+        offset = 0
+        nb_total_records = 0
+
+        # Handle offset if more than SEARCH_PAGE_SIZE results are available
+        while offset == 0 or offset < nb_total_records:
+            r = Record.api_call('get',
+                                User.api_base_url,
+                                params={'q': q, 'limit': SEARCH_PAGE_SIZE, 'offset': offset},
+                                headers=Record.build_headers(data_format='json', zone=zone,
+                                                             area='Users', rights='RW'))
+            if r is None:
+                return None, 'no response'
+
+            if not r.ok:
+                try:
+                    error_message = r.json()['errorList']['error'][0]['errorMessage']
+                except (ValueError, KeyError, IndexError):
+                    error_message = 'unknown error'
+                logging.error(f'search_users("{q}", "{zone}") - {r.status_code}: {error_message}')
+                return None, f'HTTP {r.status_code}: {error_message}'
+
+            content = r.json()
+            nb_total_records = int(content['total_record_count'])
+            if max_pages is not None and nb_total_records > max_pages * SEARCH_PAGE_SIZE:
+                logging.info(f'search_users("{q}", "{zone}"): {nb_total_records} users found, '
+                             f'more than {max_pages} pages => not fetched')
+                return None, None
+            if content.get('user') is not None:
+                users += content['user']
+            offset += SEARCH_PAGE_SIZE
+
+        logging.info(f'search_users("{q}", "{zone}"): {len(users)} users found')
+        return users, None
+
+    return retry_in_run(call)
+
+
+def fetch_user(primary_id: str, zone: str = config.IZ) -> Tuple[User, Optional[str]]:
+    """Fetch the data of a user
+
+    Parameters
+    ----------
+    primary_id: str
+        Primary ID of the user
+    zone: str
+        Code of the IZ or 'NZ'
+
+    Returns
+    -------
+    Tuple[User, Optional[str]]
+        User with its data and error message, None if no error
+    """
+    def call() -> Tuple[User, Optional[str]]:
+        user = User(primary_id, zone)
+        _ = user.data
+        return user, (user.error_msg or 'unknown error') if user.error is True else None
+
+    return retry_in_run(call, User(primary_id, zone))
+
+
+def update_user(user: User, override: Optional[List[str]] = None) -> Tuple[User, Optional[str]]:
+    """Update a user
+
+    Parameters
+    ----------
+    user: User
+        User with the updated data
+    override: List[str], optional
+        Fields to override
+
+    Returns
+    -------
+    Tuple[User, Optional[str]]
+        Updated user and error message, None if no error
+    """
+    def call() -> Tuple[User, Optional[str]]:
+        # Previous failed attempt would skip the update
+        user.error = False
+        user.error_msg = None
+        user.update(override=override)
+        return user, (user.error_msg or 'unknown error') if user.error is True else None
+
+    return retry_in_run(call, user)
@@ -0,0 +1,503 @@
+"""Command line interface of the ABN CUG automation
+
+Usage: python3 -m update_cug <command> [options]
+
+Commands:
+- run: update the CUGs, once or periodically with the "--daemon" option
+- run-workflow: run only one workflow: mediotheken matching, verwaltung or reconciliation of all CUGs
+- shard: process one shard of the Mediotheken list, for workers on separate hosts
+- merge-shards: merge the results of the shards
+- reset: reset all flags of the current state table
+- decrypt-log: decrypt a log file
+- state-summary: display a summary of the current state table
+- dead-letter: list the operations not retried anymore, or requeue them
+
+Heavy libraries (pandas, gitpython, almapiwrapper) are only imported by the commands
+using them. Maintenance commands only clone the repository if the required file is not
+available locally, in a temporary directory: the local repository is never removed.
+The other commands lock the local repository while they use it, see `repository_lock`.
+"""
+import argparse
+import csv
+import io
+import logging
+import os
+import sys
+import tempfile
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Callable, Iterator, List, Optional
+import dotenv
+import config
+
+PROJECT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    """Parse the command line and run the command
+
+    Parameters
+    ----------
+    argv: List[str], optional
+        Command line arguments, by default the arguments of the process
+    """
+    # Paths provided by the user are resolved before changing the directory
+    args = build_parser().parse_args(argv)
+
+    # Set current active directory to the project directory
+    os.chdir(PROJECT_PATH)
+
+    # Load environment variables with secrets to
+    # access the git repository and to decrypt the data
+    dotenv.load_dotenv()
+    os.environ['GIT_SSL_NO_VERIFY'] = 'true'
+
+    args.func(args)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    """Build the parser of the command line
+
+    Returns
+    -------
+    argparse.ArgumentParser
+        Parser with one sub parser for each command
+    """
+    parser = argparse.ArgumentParser(prog='update_cug', description='Update the CUGs of ABN IZ')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='update all the CUGs')
+    run_parser.add_argument('--daemon', action='store_true',
+                            help='keep running and update the CUGs periodically')
+    run_parser.add_argument('--interval', type=int, default=config.SCHEDULER_INTERVAL,
+                            help='number of seconds between two cycles in daemon mode')
+    run_parser.add_argument('--workers', type=int, default=config.NB_WORKERS,
+                            help='number of worker processes for the Mediotheken list')
+    run_parser.set_defaults(func=command_run)
+
+    workflow_parser = subparsers.add_parser('run-workflow', help='run only one workflow')
+    workflow_parser.add_argument('workflow', choices=['mediotheken', 'verwaltung', 'reconciliation'])
+    workflow_parser.add_argument('--dry-run', action='store_true',
+                                 help='only log the reconciliation plans, no user is updated')
+    workflow_parser.add_argument('--workers', type=int, default=config.NB_WORKERS,
+                                 help='number of worker processes for the Mediotheken list')
+    workflow_parser.set_defaults(func=command_run_workflow)
+
+    shard_parser = subparsers.add_parser('shard', help='process one shard of the Mediotheken list')
+    shard_parser.add_argument('index', type=int, help='index of the shard, from 0 to count - 1')
+    shard_parser.add_argument('count', type=int, help='number of shards')
+    shard_parser.set_defaults(func=command_shard)
+
+    merge_parser = subparsers.add_parser('merge-shards', help='merge the results of the shards')
+    merge_parser.add_argument('count', type=int, help='number of shards')
+    merge_parser.set_defaults(func=command_merge_shards)
+
+    reset_parser = subparsers.add_parser('reset', help='reset all flags of the current state table')
+    reset_parser.set_defaults(func=command_reset)
+
+    decrypt_parser = subparsers.add_parser('decrypt-log', help='decrypt a log file')
+    decrypt_parser.add_argument('path', nargs='?', type=os.path.abspath,
+                                help='path of the encrypted log file, by default the log of the last run')
+    decrypt_parser.add_argument('--output', type=os.path.abspath,
+                                help='path of the decrypted log file')
+    decrypt_parser.set_defaults(func=command_decrypt_log)
+
+    summary_parser = subparsers.add_parser('state-summary', help='display a summary of the current state table')
+    summary_parser.set_defaults(func=command_state_summary)
+
+    dead_letter_parser = subparsers.add_parser('dead-letter',
+                                               help='list the operations not retried anymore, or requeue them')
+    dead_letter_parser.add_argument('--workflow', choices=['mediotheken', 'reconciliation'],
+                                    help='only the entries of this workflow')
+    dead_letter_parser.add_argument('--key', help='only the entry with this key')
+    dead_letter_parser.add_argument('--requeue', action='store_true',
+                                    help='move the entries back to the retry queue and push it')
+    dead_letter_parser.set_defaults(func=command_dead_letter)
+
+    return parser
+
+
+def get_repo(local_path: str = config.REPOSITORY_PATH):
+    """Return the git repository of ABN, not cloned
+
+    Parameters
+    ----------
+    local_path: str
+        Path of the local repository
+
+    Returns
+    -------
+    GitRepo
+        The git repository object
+    """
+    from update_cug.gitrepo import GitRepo
+
+    return GitRepo(
+        local_path=local_path,
+        remote_url=config.REPOSITORY_URL,
+        token_key=config.REPOSITORY_TOKEN_KEY,
+        access_token=os.getenv('abn_slsp_exchange_access')
+    )
+
+
+@contextmanager
+def repository_lock() -> Iterator[None]:
+    """Prevent two processes from using the local repository at the same time
+
+    The daemon and the one-shot commands clone the repository in the same directory and
+    remove it at the end, a command started while the daemon runs would remove its clone.
+    The lock file contains the PID of the process holding the lock. On POSIX systems, the
+    lock of a process no longer running is taken over.
+    """
+    while True:
+        try:
+            lock_file = os.open(config.REPOSITORY_LOCK_PATH, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            with open(config.REPOSITORY_LOCK_PATH) as f:
+                pid = f.read().strip()
+
+            if is_running(pid):
+                sys.exit(f'Local repository {config.REPOSITORY_PATH} used by the process {pid}, '
+                         f'remove {config.REPOSITORY_LOCK_PATH} if this process is not running anymore')
+
+            logging.warning(f'Lock of the process {pid} not running anymore => removed')
+            os.remove(config.REPOSITORY_LOCK_PATH)
+
+    with os.fdopen(lock_file, 'w') as f:
+        f.write(str(os.getpid()))
+
+    try:
+        yield
+    finally:
+        os.remove(config.REPOSITORY_LOCK_PATH)
+
+
+def is_running(pid: str) -> bool:
+    """Check if a process is running, always True if it can't be checked
+
+    Parameters
+    ----------
+    pid: str
+        PID of the process, as written in the lock file
+
+    Returns
+    -------
+    bool
+        False if the process is not running
+    """
+    if os.name != 'posix' or not pid.isdigit():
+        return True
+
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+
+    return True
+
+
+def run_task(task: Callable[[], None],
+             files_to_commit: List[str],
+             files_to_remove: Optional[List[str]] = None,
+             encrypted_log_file_path: str = config.PATH_TO_ENCRYPTED_LOG,
+             push: bool = True) -> None:
+    """Clone the repository, run the task and push the updated files with the encrypted log
+
+    Parameters
+    ----------
+    task: Callable[[], None]
+        Function updating the files of the repository
+    files_to_commit: List[str]
+        Files updated by the task
+    files_to_remove: List[str], optional
+        Files removed by the task
+    encrypted_log_file_path: str
+        Path of the encrypted log file
+    push: bool
+        If False, nothing is pushed, the log is only displayed in the console
+    """
+    from update_cug import crypto, http_session, tools
+
+    # The daemon and the other commands use the same local repository
+    with repository_lock():
+        repo = get_repo()
+        repo.clone_repo()
+
+        log_file_path = tools.configure_logger()
+        logging.info(f'Starting process at {datetime.now()}')
+
+        # All the API calls of the run use the same pooled session
+        http_session.install_session()
+
+        task()
+
+        http_session.log_session_stats()
+        logging.info(f'Process ended at {datetime.now()}')
+
+        if push is True:
+            # Encrypt the data
+            encrypted_log_file_path = crypto.encrypt_log_file(log_file_path, encrypted_log_file_path)
+            tools.close_loggers()
+
+            # Push repository to remote
+            repo.push_repo(files_to_commit + [encrypted_log_file_path], files_to_remove)
+        else:
+            tools.close_loggers()
+
+        # Remove the local repository
+        repo.delete_local_repo()
+
+
+@contextmanager
+def local_files(file_paths: List[str]) -> Iterator[List[str]]:
+    """Make files of the repository available locally
+
+    If the first file is available, the paths are returned unchanged. Else the repository
+    is cloned in a temporary directory, removed when leaving the context, and the paths in
+    this clone are returned. The local repository is never changed.
+
+    Parameters
+    ----------
+    file_paths: List[str]
+        Paths of the files, the first file is required
+
+    Returns
+    -------
+    Iterator[List[str]]
+        Paths of the files to read
+    """
+    if os.path.isfile(file_paths[0]):
+        yield file_paths
+        return
+
+    repository_path = os.path.abspath(config.REPOSITORY_PATH)
+    relative_paths = [os.path.relpath(os.path.abspath(file_path), repository_path) for file_path in file_paths]
+    if relative_paths[0].startswith('..'):
+        sys.exit(f'File not found: {file_paths[0]}')
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        repo = get_repo(os.path.join(temp_dir, 'repo'))
+        repo.clone_repo()
+        cloned_paths = [os.path.join(repo.local_path, relative_path) for relative_path in relative_paths]
+
+        if not os.path.isfile(cloned_paths[0]):
+            sys.exit(f'File not found in the repository: {file_paths[0]}')
+
+        yield cloned_paths
+
+
+def command_run(args: argparse.Namespace) -> None:
+    """Update all the CUGs and send the report"""
+    if args.daemon is True:
+        from update_cug.scheduler import Scheduler
+
+        with repository_lock():
+            repo = get_repo()
+            repo.clone_repo()
+            Scheduler(repo, args.interval).run()
+        return
+
+    from update_cug import reconcile, tools
+
+    def task() -> None:
+        reports = list()
+        reports.append(run_mediotheken(args.workers))
+
+        # No report in dry run
+        report = reconcile.workflow()
+        if report is not None:
+            reports.append(report)
+
+        tools.send_report(reports)
+
+    run_task(task, [config.PATH_TO_DATA_CURRENT_STATE,
+                    config.PATH_TO_DEPARTED_MEMBERS,
+                    config.PATH_TO_REPORT_MEDIOTHEKEN,
+                    config.PATH_TO_REPORT_VERWALTUNG,
+                    config.PATH_TO_REPORT_RECONCILIATION,
+                    config.PATH_TO_RETRY_QUEUE,
+                    config.PATH_TO_RETRY_DEAD_LETTER])
+
+
+def command_run_workflow(args: argparse.Namespace) -> None:
+    """Run only one workflow and send the report"""
+    from update_cug import tools
+
+    if args.workflow == 'mediotheken':
+        def workflow() -> str:
+            return run_mediotheken(args.workers)
+
+        files_to_commit = [config.PATH_TO_DATA_CURRENT_STATE,
+                           config.PATH_TO_DEPARTED_MEMBERS,
+                           config.PATH_TO_REPORT_MEDIOTHEKEN]
+    else:
+        from update_cug import reconcile
+        cug_codes = [config.VERWALTUNG_USER_GROUP_CODE] if args.workflow == 'verwaltung' else None
+
+        # A preview doesn't write, push or send anything, the plans are only logged
+        if args.dry_run is True or config.RECONCILIATION_DRY_RUN is True:
+            run_task(lambda: reconcile.workflow(cug_codes, dry_run=True), [], push=False)
+            return
+
+        def workflow() -> str:
+            return reconcile.workflow(cug_codes, dry_run=False)
+
+        files_to_commit = [config.PATH_TO_DEPARTED_MEMBERS,
+                           config.PATH_TO_REPORT_VERWALTUNG,
+                           config.PATH_TO_REPORT_RECONCILIATION]
+
+    def task() -> None:
+        tools.send_report([workflow()])
+
+    run_task(task, files_to_commit + [config.PATH_TO_RETRY_QUEUE, config.PATH_TO_RETRY_DEAD_LETTER])
+
+
+def command_shard(args: argparse.Namespace) -> None:
+    """Process one shard of the Mediotheken list and push the shard files"""
+    from update_cug import shard
+
+    shard_paths = [shard.get_shard_path(file_path, args.index, args.count)
+                   for file_path in [config.PATH_TO_DATA_CURRENT_STATE,
+                                     config.PATH_TO_RETRY_QUEUE,
+                                     config.PATH_TO_RETRY_DEAD_LETTER]]
+
+    run_task(lambda: shard.process_shard(args.index, args.count),
+             shard_paths,
+             encrypted_log_file_path=shard.get_shard_path(config.PATH_TO_ENCRYPTED_LOG, args.index, args.count))
+
+
+def command_merge_shards(args: argparse.Namespace) -> None:
+    """Merge the results of the shards and send the report"""
+    from update_cug import shard, tools
+
+    def task() -> None:
+        tools.send_report([shard.merge_shards(args.count)])
+
+    run_task(task,
+             [config.PATH_TO_DATA_CURRENT_STATE,
+              config.PATH_TO_DEPARTED_MEMBERS,
+              config.PATH_TO_REPORT_MEDIOTHEKEN,
+              config.PATH_TO_RETRY_QUEUE,
+              config.PATH_TO_RETRY_DEAD_LETTER],
+             files_to_remove=shard.get_shard_paths(args.count))
+
+
+def run_mediotheken(nb_workers: int) -> str:
+    """Run the Mediotheken workflow, in worker processes if more than one worker is required
+
+    Parameters
+    ----------
+    nb_workers: int
+        Number of worker processes
+
+    Returns
+    -------
+    str
+        string containing the report data
+    """
+    if nb_workers > 1:
+        from update_cug import shard
+        return shard.run_workers(nb_workers)
+
+    from update_cug import update_mediotheken
+    return update_mediotheken.workflow()
+
+
+def command_reset(_: argparse.Namespace) -> None:
+    """Reset all flags of the current state table"""
+    from update_cug import update_mediotheken
+
+    run_task(update_mediotheken.reset_current_state_table, [config.PATH_TO_DATA_CURRENT_STATE])
+
+
+def command_decrypt_log(args: argparse.Namespace) -> None:
+    """Decrypt a log file, by default the log of the last run"""
+    from update_cug import crypto
+
+    log_file_path = args.path if args.path is not None else config.PATH_TO_ENCRYPTED_LOG
+
+    with local_files([log_file_path]) as [local_log_file_path]:
+        decrypted_file_path = args.output
+        if decrypted_file_path is None and local_log_file_path != log_file_path:
+            # The temporary clone is removed at the end, the decrypted log is written in the project directory
+            decrypted_file_path = os.path.basename(log_file_path)[:-4] + '_decrypted.log'
+
+        decrypted_file_path = crypto.decrypt_log_file(local_log_file_path, decrypted_file_path)
+
+    print(f'Decrypted log file: {os.path.abspath(decrypted_file_path)}')
+
+
+def command_state_summary(_: argparse.Namespace) -> None:
+    """Display the number of users of the current state table by status and the retry queue entries"""
+    with local_files([config.PATH_TO_DATA_CURRENT_STATE,
+                      config.PATH_TO_RETRY_QUEUE,
+                      config.PATH_TO_RETRY_DEAD_LETTER]) as [state_path, retry_queue_path, dead_letter_path]:
+        rows = read_encrypted_csv(state_path)
+        retry_rows = read_encrypted_csv(retry_queue_path)
+        dead_letter_rows = read_encrypted_csv(dead_letter_path)
+
+    def count(condition: Callable[[dict], bool]) -> int:
+        return len([row for row in rows if condition(row)])
+
+    summary = {'Users': len(rows),
+               'CUG updated': count(lambda row: row['cug_updated'] == 'True'),
+               'Barcode added': count(lambda row: row['barcode_added'] == 'True'),
+               'Skipped': count(lambda row: row['skipped'] == 'True'),
+               'Pending': count(lambda row: row['cug_updated'] != 'True' and row['skipped'] != 'True'),
+               'With message': count(lambda row: row['message'] != ''),
+               'To retry': len(retry_rows),
+               'Dead letter': len(dead_letter_rows)}
+
+    print(f'Current state table: {config.PATH_TO_DATA_CURRENT_STATE}')
+    for label, value in summary.items():
+        print(f'{label + ":":<15}{value:>8}')
+
+
+def command_dead_letter(args: argparse.Namespace) -> None:
+    """List the entries of the dead letter file, or requeue them"""
+    if args.requeue is True:
+        def task() -> None:
+            from update_cug.retry_queue import RetryQueue
+
+            retry_queue = RetryQueue()
+            retry_queue.requeue(args.workflow, args.key)
+            retry_queue.save()
+
+        run_task(task, [config.PATH_TO_RETRY_QUEUE, config.PATH_TO_RETRY_DEAD_LETTER])
+        return
+
+    with local_files([config.PATH_TO_RETRY_DEAD_LETTER]) as [dead_letter_path]:
+        rows = read_encrypted_csv(dead_letter_path)
+
+    rows = [row for row in rows if args.workflow in [None, row['workflow']] and args.key in [None, row['key']]]
+    for row in rows:
+        print(f'{row["workflow"]} {row["key"]}: {row["operation"]} failed {row["attempts"]} times since '
+              f'{row["first_failure"]}, {row["error_class"]} error: {row["error_msg"]}')
+
+    print(f'{len(rows)} entries in dead letter')
+
+
+def read_encrypted_csv(file_path: str) -> List[dict]:
+    """Decrypt a CSV file of the repository without pandas
+
+    Parameters
+    ----------
+    file_path: str
+        Path of the encrypted CSV file, separator is ';'
+
+    Returns
+    -------
+    List[dict]
+        One dictionary for each row, empty list if the file doesn't exist
+    """
+    from update_cug import crypto
+
+    if not os.path.isfile(file_path):
+        return []
+
+    decrypted_data = crypto.decrypt_file(file_path)
+
+    return list(csv.DictReader(io.StringIO(decrypted_data.decode()), delimiter=';'))
@@ -0,0 +1,107 @@
+import os
+import config
+from cryptography.fernet import Fernet
+from typing import Iterator, Optional
+
+
+def get_cipher_suite() -> Fernet:
+    """Return the cipher suite used to encrypt and decrypt the data
+
+    Note:
+        The data is encrypted using Fernet encryption algorithm.
+        The secret key is stored in the environment variable `abn_slsp_exchange_secret`.
+    """
+    return Fernet(os.getenv('abn_slsp_exchange_secret'))
+
+
+def decrypt_file(file_path: str) -> bytes:
+    """Decrypt the file and return its content
+
+    Parameters
+    ----------
+    file_path: str
+        Path of the encrypted file
+
+    Returns
+    -------
+    bytes
+        decrypted content of the file
+    """
+    return b''.join(iter_decrypt_file(file_path))
+
+
+def iter_decrypt_file(file_path: str) -> Iterator[bytes]:
+    """Decrypt the file block by block
+
+    A file can contain several Fernet tokens, one by line, each token is decrypted
+    when it is read. A file written in one block contains only one token.
+
+    Parameters
+    ----------
+    file_path: str
+        Path of the encrypted file
+
+    Returns
+    -------
+    Iterator[bytes]
+        decrypted content of each block of the file
+    """
+    cipher_suite = get_cipher_suite()
+
+    with open(file_path, "rb") as encrypted_file:
+        for token in encrypted_file:
+            token = token.strip()
+            if len(token) > 0:
+                yield cipher_suite.decrypt(token)
+
+
+def decrypt_log_file(log_file_path: str, decrypted_file_path: Optional[str] = None) -> str:
+    """Decrypt the log file and return the decrypted file path
+
+    Parameters
+    ----------
+    log_file_path: str
+        Path of the encrypted log file
+    decrypted_file_path: str, optional
+        Path of the decrypted log file, by default next to the encrypted log file
+        with suffix '_decrypted.log'
+
+    Note:
+        The data is encrypted using Fernet encryption algorithm.
+        The secret key is stored in the environment variable `abn_slsp_exchange_secret`.
+        The file is decrypted and written to the file.
+    """
+    decrypted_data = decrypt_file(log_file_path)
+
+    if decrypted_file_path is None:
+        decrypted_file_path = log_file_path[:-4] + '_decrypted.log'
+    with open(decrypted_file_path, "wb") as decrypted_file:
+        decrypted_file.write(decrypted_data)
+
+    return decrypted_file_path
+
+
+def encrypt_log_file(log_file_path: str, encrypted_log_file_path: str = config.PATH_TO_ENCRYPTED_LOG) -> str:
+    """Encrypt the log file and write to the file
+
+    Parameters
+    ----------
+    log_file_path: str
+        Path of the log file
+    encrypted_log_file_path: str
+        Path of the encrypted log file, by default the log of the last run
+
+    Note:
+        The data is encrypted using Fernet encryption algorithm.
+        The secret key is stored in the environment variable `abn_slsp_exchange_secret`.
+        The file is encrypted and written to the file.
+    """
+    with open(log_file_path, "rb") as log_file:
+        log_data = log_file.read()
+
+    encrypted_data = get_cipher_suite().encrypt(log_data)
+
+    with open(encrypted_log_file_path, "wb") as encrypted_file:
+        encrypted_file.write(encrypted_data)
+
+    return encrypted_log_file_path
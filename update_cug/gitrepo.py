@@ -4,7 +4,7 @@ import git
 import config
 import logging
 from datetime import datetime
-from typing import List
+from typing import List, Optional
 
 
 class GitRepo:
@@ -55,17 +55,75 @@ class GitRepo:
         self.repo = git.Repo.clone_from(f'https://{self.token_key}:{self.access_token}@{self.remote_url}',
                                         self.local_path)
 
-    def push_repo(self, files_to_commit: List[str]) -> None:
+    def pull_repo(self) -> None:
         """
-        Push the git repository
+        Update the local git repository to the state of the remote
+
+        The repository is cloned if no local copy is available, for example if the
+        directory or its remote has been removed by another process. Local changes are
+        discarded, they are expected to be already pushed.
+        """
+        if self.repo is None or not self.has_remote():
+            if self.repo is not None:
+                logging.warning(f'Local repository {self.local_path} not available => cloned again')
+            self.clone_repo()
+            return
+
+        origin = self.repo.remote(name="origin")
+        origin.fetch()
+        self.repo.head.reset(f'origin/{self.repo.active_branch.name}', index=True, working_tree=True)
+
+    def has_remote(self) -> bool:
+        """
+        Check if the local repository still exists with its "origin" remote
+        """
+        if not os.path.isdir(os.path.join(self.local_path, '.git')):
+            return False
+
+        try:
+            return 'origin' in [remote.name for remote in git.Repo(self.local_path).remotes]
+        except git.exc.InvalidGitRepositoryError:
+            return False
+
+    def push_repo(self, files_to_commit: List[str], files_to_remove: Optional[List[str]] = None) -> None:
         """
-        files_to_commit = [f.replace(config.REPOSITORY_PATH, '')[1:] for f in files_to_commit]
+        Push the git repository
+
+        If the push is rejected, for example because workers of other shards pushed in the
+        meantime, the local commit is rebased on the remote and pushed again.
 
+        Parameters
+        ----------
+        files_to_commit: List[str]
+            Files to commit, files not written during the run are ignored
+        files_to_remove: List[str], optional
+            Files to remove from the repository, files not tracked are ignored
+        """
+        files_to_commit = [self.get_relative_path(f) for f in files_to_commit if os.path.isfile(f)]
         self.repo.index.add(files_to_commit)
+
+        if files_to_remove is not None:
+            tracked_files = self.repo.git.ls_files().splitlines()
+            files_to_remove = [self.get_relative_path(f) for f in files_to_remove
+                               if self.get_relative_path(f) in tracked_files]
+            if len(files_to_remove) > 0:
+                self.repo.index.remove(files_to_remove, working_tree=True)
+
         self.repo.index.commit(f'Update task {datetime.now().strftime("%d/%m/%Y %H:%M:%S")}')
 
-        try:
-            self.repo.remote(name="origin").push()
-        except Exception as e:
-            logging.error(f"an exception occured: {e}")
-        pass
\ No newline at end of file
+        origin = self.repo.remote(name="origin")
+        for push_try in [1, 2, 3]:
+            try:
+                if push_try > 1:
+                    origin.pull(rebase=True)
+                origin.push().raise_if_error()
+                return
+            except Exception as e:
+                logging.error(f"an exception occured: try {push_try} - {e}")
+
+    @staticmethod
+    def get_relative_path(file_path: str) -> str:
+        """
+        Return the path of a file relative to the root of the repository
+        """
+        return file_path.replace(config.REPOSITORY_PATH, '')[1:]
@@ -0,0 +1,133 @@
+import logging
+from collections import defaultdict
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3 import HTTPConnectionPool
+import almapiwrapper.record
+import almapiwrapper.users.utils
+import config
+
+# Session installed for the current process
+_session: Optional['PooledSession'] = None
+
+
+class PooledSession:
+    """
+    Class replacing the `requests` module in almapiwrapper to send all the API calls
+    with one session
+
+    The session keeps the connections alive in a pool, TLS handshakes are only done
+    for new connections, and accepts compressed responses. Other attributes, like
+    `requests.exceptions`, are the ones of the `requests` module.
+
+    Attributes:
+    -----------
+    session: requests.Session
+        The session used for the API calls
+    stats: Dict[str, Dict[str, int]]
+        For each host, number of responses, bytes received on the wire and bytes of content
+        since the last log
+    logged_counts: Dict[HTTPConnectionPool, Tuple[int, int]]
+        For each connection pool, number of requests and of connections at the last log
+    """
+    def __init__(self, pool_size: int):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({'Accept-Encoding': 'gzip, deflate',
+                                     'Connection': 'keep-alive'})
+        self.session.hooks['response'].append(self.count_response)
+        self.stats: Dict[str, Dict[str, int]] = defaultdict(lambda: {'responses': 0,
+                                                                     'wire_bytes': 0,
+                                                                     'content_bytes': 0})
+        self.logged_counts: Dict[HTTPConnectionPool, Tuple[int, int]] = dict()
+
+    def __getattr__(self, name: str):
+        return getattr(requests, name)
+
+    def get(self, *args, **kwargs) -> requests.Response:
+        return self.session.get(*args, **kwargs)
+
+    def put(self, *args, **kwargs) -> requests.Response:
+        return self.session.put(*args, **kwargs)
+
+    def post(self, *args, **kwargs) -> requests.Response:
+        return self.session.post(*args, **kwargs)
+
+    def delete(self, *args, **kwargs) -> requests.Response:
+        return self.session.delete(*args, **kwargs)
+
+    def count_response(self, r: requests.Response, *_, **__) -> requests.Response:
+        """
+        Response hook counting the received bytes, before and after decompression
+        """
+        content = r.content
+        host_stats = self.stats[urlparse(r.url).hostname]
+        host_stats['responses'] += 1
+        host_stats['wire_bytes'] += r.raw.tell() if r.raw is not None else len(content)
+        host_stats['content_bytes'] += len(content)
+
+        return r
+
+    def log_stats(self) -> None:
+        """
+        Log the connection reuse and the compression statistics of each host since the last log
+
+        The session is kept between the cycles of the daemon, the statistics of each cycle
+        are logged and then reset.
+        """
+        adapter = self.session.get_adapter('https://')
+        pools = adapter.poolmanager.pools
+
+        for key in pools.keys():
+            pool = pools[key]
+            logged_requests, logged_connections = self.logged_counts.get(pool, (0, 0))
+            num_requests = pool.num_requests - logged_requests
+            num_connections = pool.num_connections - logged_connections
+            self.logged_counts[pool] = (pool.num_requests, pool.num_connections)
+            if num_requests == 0:
+                continue
+            reuse = 1 - num_connections / num_requests
+            host_stats = self.stats[pool.host]
+            ratio = host_stats['wire_bytes'] / host_stats['content_bytes'] if host_stats['content_bytes'] > 0 else 1
+            logging.info(f'HTTP session {pool.host}: {num_requests} requests, '
+                         f'{num_connections} connections opened ({reuse:.0%} reused), '
+                         f'{host_stats["wire_bytes"]} bytes received for {host_stats["content_bytes"]} '
+                         f'bytes of content ({ratio:.0%})')
+
+        self.stats.clear()
+
+
+def install_session(pool_size: int = config.HTTP_POOL_SIZE) -> PooledSession:
+    """Install the pooled session for all the API calls of almapiwrapper in the current process
+
+    The session is installed only once, next calls return the installed session.
+
+    Parameters
+    ----------
+    pool_size: int
+        Number of connections kept alive for each host, the API calls of a process are sequential
+
+    Returns
+    -------
+    PooledSession
+        The installed session
+    """
+    global _session
+
+    if _session is None:
+        _session = PooledSession(pool_size)
+        almapiwrapper.record.requests = _session
+        almapiwrapper.users.utils.requests = _session
+        logging.info(f'HTTP session installed, pool size: {pool_size}')
+
+    return _session
+
+
+def log_session_stats() -> None:
+    """Log the statistics of the installed session, nothing is done if no session is installed
+    """
+    if _session is not None:
+        _session.log_stats()
@@ -0,0 +1,398 @@
+import logging
+import math
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional, Set, Tuple
+import pandas as pd
+import config
+from update_cug import alma
+
+# German transliteration applied before removing the accents, "Müller" and "Mueller" get the same key
+TRANSLITERATION = str.maketrans({'ä': 'ae', 'ö': 'oe', 'ü': 'ue', 'ß': 'ss'})
+
+# Letters without decomposition, replaced in all keys
+FOLDING = str.maketrans({'ß': 'ss', 'æ': 'ae', 'œ': 'oe', 'ø': 'o', 'ł': 'l', 'đ': 'd'})
+
+# Hyphens, apostrophes, dots and white spaces separate the parts of a name
+NAME_SEPARATORS = r"[\s\-\u2010-\u2015'\u2019.]+"
+
+NAME_KEY_COLUMNS = ['last_name_key', 'first_name_key', 'last_name_folded', 'first_name_folded']
+
+# Transliterations reverted to search the accounts with umlauts, only for names with umlauts in the source list
+DETRANSLITERATION = [('ae', 'a'), ('oe', 'o'), ('ue', 'u')]
+
+
+def normalize_names(names: pd.Series, transliterate: bool = True) -> pd.Series:
+    """Compute the canonical keys of a column of names
+
+    Names are lower cased, accents are removed, the parts of the name are separated
+    by one space.
+
+    Parameters
+    ----------
+    names: pd.Series
+        Names to normalize
+    transliterate: bool
+        If True, German umlauts are transliterated ("ü" => "ue"), else only the accent is
+        removed ("ü" => "u")
+
+    Returns
+    -------
+    pd.Series
+        Keys of the names
+    """
+    keys = names.fillna('').astype(str).str.lower()
+
+    if transliterate is True:
+        keys = keys.str.translate(TRANSLITERATION)
+
+    return (keys.str.translate(FOLDING)
+                .str.normalize('NFKD')
+                .str.replace(r'[\u0300-\u036f]', '', regex=True)
+                .str.replace(NAME_SEPARATORS, ' ', regex=True)
+                .str.strip())
+
+
+def get_name_keys(df: pd.DataFrame) -> pd.DataFrame:
+    """Compute the name keys of a table with last_name and first_name columns
+
+    Both the transliterated and the accent folded keys are computed, Alma accounts
+    don't always use the same spelling as the source list.
+
+    Parameters
+    ----------
+    df: pd.DataFrame
+        Table with last_name and first_name columns
+
+    Returns
+    -------
+    pd.DataFrame
+        Table with the same index and the columns of NAME_KEY_COLUMNS
+    """
+    return pd.DataFrame({'last_name_key': normalize_names(df['last_name']),
+                         'first_name_key': normalize_names(df['first_name']),
+                         'last_name_folded': normalize_names(df['last_name'], transliterate=False),
+                         'first_name_folded': normalize_names(df['first_name'], transliterate=False)},
+                        index=df.index,
+                        columns=NAME_KEY_COLUMNS)
+
+
+def get_match_keys(df: pd.DataFrame) -> pd.DataFrame:
+    """Compute the name and birth date keys of the rows of the current state table
+
+    Parameters
+    ----------
+    df: pd.DataFrame
+        Current state data
+
+    Returns
+    -------
+    pd.DataFrame
+        Table with the same index, the columns of NAME_KEY_COLUMNS and birth_date_key
+    """
+    keys = get_name_keys(df)
+    keys['birth_date_key'] = df['birth_date'].dt.strftime('%Y-%m-%d').fillna('')
+
+    return keys
+
+
+def get_birth_date_key(user_data: Dict) -> str:
+    """Return the birth date key of the data of an Alma user
+
+    Parameters
+    ----------
+    user_data: Dict
+        Data of the user, birth date in format 'YYYY-MM-DDZ'
+
+    Returns
+    -------
+    str
+        Birth date in format 'YYYY-MM-DD', empty string if no birth date
+    """
+    return (user_data.get('birth_date') or '')[:10]
+
+
+def get_search_terms(row_keys: pd.Series, name: str) -> List[str]:
+    """Return the terms of the searches of the accounts which may match the name of a row
+
+    Alma only finds the spelling of the query. The name is searched transliterated and accent
+    folded, "Müller" is searched as "mueller" and "muller". If the name has umlauts, the
+    transliteration is also reverted in the whole name. Names without umlauts are not changed,
+    "Doe" is not searched as "do". Only the longest part of each spelling is searched, so
+    hyphens and additional names don't prevent finding the account. The found accounts
+    are then filtered with `match_names`.
+
+    Parameters
+    ----------
+    row_keys: pd.Series
+        Keys of the row, see `get_match_keys`
+    name: str
+        'last_name' or 'first_name'
+
+    Returns
+    -------
+    List[str]
+        Distinct search terms, empty if the name is empty
+    """
+    key = row_keys[f'{name}_key']
+    folded_key = row_keys[f'{name}_folded']
+    spellings = [key, folded_key]
+
+    if key != folded_key:
+        reverted_key = key
+        for transliteration, letter in DETRANSLITERATION:
+            reverted_key = reverted_key.replace(transliteration, letter)
+        spellings.append(reverted_key)
+
+    terms = []
+    for spelling in spellings:
+        if spelling == '':
+            continue
+        term = max(spelling.split(), key=len)
+        if term not in terms:
+            terms.append(term)
+
+    return terms
+
+
+def get_row_queries(row_keys: pd.Series) -> List[str]:
+    """Return the queries searching the accounts by last name and first name of a row
+
+    Each spelling of the last name is searched with the same spelling of the first name,
+    see `get_search_terms`.
+
+    Parameters
+    ----------
+    row_keys: pd.Series
+        Keys of the row, see `get_match_keys`
+
+    Returns
+    -------
+    List[str]
+        Distinct queries in API syntax
+    """
+    last_names = get_search_terms(row_keys, 'last_name')
+    first_names = get_search_terms(row_keys, 'first_name')
+
+    queries = []
+    for j, last_name in enumerate(last_names):
+        query = f'last_name~{last_name}'
+        if len(first_names) > 0:
+            query += f' and first_name~{first_names[min(j, len(first_names) - 1)]}'
+        if query not in queries:
+            queries.append(query)
+
+    return queries
+
+
+def match_names(row_keys: pd.Series, candidate_keys: pd.DataFrame) -> pd.Series:
+    """Check which candidates match the name of a row
+
+    A candidate matches if all the parts of the last name and of the first name of the
+    row are parts of its names, with the transliterated or with the accent folded keys.
+    "Anna" matches "Anna Maria" and "Müller" matches "Müller-Meier" like with the API search.
+
+    Parameters
+    ----------
+    row_keys: pd.Series
+        Keys of the row, see `get_match_keys`
+    candidate_keys: pd.DataFrame
+        Keys of the candidates, see `get_name_keys`
+
+    Returns
+    -------
+    pd.Series
+        True for the matching candidates
+    """
+    def contains(row_key: str, candidate_names: pd.Series) -> pd.Series:
+        row_parts = set(row_key.split())
+        return candidate_names.map(lambda name: row_parts <= set(name.split()))
+
+    return ((contains(row_keys['last_name_key'], candidate_keys['last_name_key'])
+             & contains(row_keys['first_name_key'], candidate_keys['first_name_key']))
+            | (contains(row_keys['last_name_folded'], candidate_keys['last_name_folded'])
+               & contains(row_keys['first_name_folded'], candidate_keys['first_name_folded'])))
+
+
+class CandidateSearch:
+    """
+    Class to search the Alma accounts matching the rows of the current state table
+
+    Rows are grouped in blocks by the key of their last name. Blocks of at least
+    MATCHING_BLOCK_MIN_ROWS rows are searched once with the last name only and the
+    result serves all the rows of the block. A block search can't need more requests
+    than the searches by last name and first name of its rows, else these narrower
+    searches are used. The queries are built with the normalized spellings of the
+    names, see `get_search_terms`, and the candidates are filtered by name keys, only
+    the remaining candidates need to be fetched.
+
+    The rows to process are added to the blocks before the first search, the whole list
+    can be added chunk by chunk and the results of the block searches serve all the chunks.
+    A block is dropped when the candidates of its last row are returned.
+
+    Attributes:
+    -----------
+    block_sizes: Counter
+        Number of rows to process for each last name key
+    block_terms: Dict[str, Set[str]]
+        Search terms of the last names of each block
+    block_max_pages: Counter
+        Number of searches by row of each block, maximum number of requests of the block search
+    block_searches: Dict[str, Tuple[Optional[List[Dict]], Optional[str]]]
+        Result of the searches of the blocks already searched, no users and no error if the
+        block has too many results
+    block_remaining: Counter
+        Number of rows of each block whose candidates are not returned yet
+    row_searches: Dict[str, Dict[str, List[Dict]]]
+        Results of the searches by row of each block, by query, identical rows are searched once
+    nb_searches: int
+        Number of API searches
+    nb_block_searches: int
+        Number of blocks searched by last name
+    nb_large_blocks: int
+        Number of blocks with too many results, searched by row
+    """
+    def __init__(self):
+        self.block_sizes = Counter()
+        self.block_terms: Dict[str, Set[str]] = defaultdict(set)
+        self.block_max_pages = Counter()
+        self.block_searches: Dict[str, Tuple[Optional[List[Dict]], Optional[str]]] = dict()
+        self.block_remaining = Counter()
+        self.row_searches: Dict[str, Dict[str, List[Dict]]] = defaultdict(dict)
+        self.nb_searches = 0
+        self.nb_block_searches = 0
+        self.nb_large_blocks = 0
+
+    def add_rows(self, keys: pd.DataFrame) -> None:
+        """
+        Add rows to process to their blocks
+
+        Parameters
+        ----------
+        keys: pd.DataFrame
+            Match keys of the rows, see `get_match_keys`
+        """
+        for _, row_keys in keys.iterrows():
+            last_name_key = row_keys['last_name_key']
+            self.block_sizes[last_name_key] += 1
+            self.block_remaining[last_name_key] += 1
+            self.block_terms[last_name_key].update(get_search_terms(row_keys, 'last_name'))
+            self.block_max_pages[last_name_key] += len(get_row_queries(row_keys))
+
+    def search(self, q: str, max_pages: Optional[int] = None) -> Tuple[Optional[List[Dict]], Optional[str]]:
+        """
+        Search users with the API and count the searches
+        """
+        self.nb_searches += 1
+        return alma.search_users(q, max_pages=max_pages)
+
+    def search_block(self, last_name_key: str) -> Tuple[Optional[List[Dict]], Optional[str]]:
+        """
+        Search users with the last names of a block, each spelling of the block is searched once
+
+        The number of requests is limited to the number of searches by last name and first
+        name of the rows of the block.
+        """
+        if last_name_key not in self.block_searches:
+            max_pages = self.block_max_pages[last_name_key]
+            users = dict()
+
+            for term in sorted(self.block_terms[last_name_key]):
+                if max_pages < 1:
+                    self.block_searches[last_name_key] = (None, None)
+                    self.nb_large_blocks += 1
+                    break
+                block_users, error_msg = self.search(f'last_name~{term}', max_pages)
+                if error_msg is not None or block_users is None:
+                    self.block_searches[last_name_key] = (None, error_msg)
+                    self.nb_large_blocks += int(error_msg is None)
+                    break
+                max_pages -= max(1, math.ceil(len(block_users) / alma.SEARCH_PAGE_SIZE))
+                users.update({user['primary_id']: user for user in block_users})
+            else:
+                self.block_searches[last_name_key] = (list(users.values()), None)
+                self.nb_block_searches += 1
+
+        return self.block_searches[last_name_key]
+
+    def search_row(self, row_keys: pd.Series) -> Tuple[Optional[List[Dict]], Optional[str]]:
+        """
+        Search users with the last name and the first name of a row
+
+        The results are kept until the last row of the block, each query is searched once.
+        """
+        last_name_key = row_keys['last_name_key']
+        users = dict()
+        for q in get_row_queries(row_keys):
+            if q in self.row_searches.get(last_name_key, dict()):
+                row_users = self.row_searches[last_name_key][q]
+            else:
+                row_users, error_msg = self.search(q)
+                if error_msg is not None:
+                    return None, error_msg
+                if last_name_key in self.block_remaining:
+                    self.row_searches[last_name_key][q] = row_users
+            users.update({user['primary_id']: user for user in row_users})
+
+        return list(users.values()), None
+
+    def get_candidates(self, row_keys: pd.Series) -> Tuple[Optional[List[str]], Optional[str]]:
+        """
+        Return the primary IDs of the eduID accounts matching the name of a row
+
+        Parameters
+        ----------
+        row_keys: pd.Series
+            Keys of the row, see `get_match_keys`
+
+        Returns
+        -------
+        Tuple[Optional[List[str]], Optional[str]]
+            Primary IDs of the candidates and error message of the search, None if no error
+        """
+        last_name_key = row_keys['last_name_key']
+        users, error_msg = None, None
+
+        if self.block_sizes.get(last_name_key, 0) >= config.MATCHING_BLOCK_MIN_ROWS:
+            users, error_msg = self.search_block(last_name_key)
+
+        # Small blocks and blocks with too many results
+        if users is None and error_msg is None:
+            users, error_msg = self.search_row(row_keys)
+
+        self.release_row(last_name_key)
+
+        if error_msg is not None:
+            return None, error_msg
+
+        users = [user for user in users if user['primary_id'].endswith('eduid.ch')]
+        if len(users) == 0:
+            return [], None
+
+        candidates = pd.DataFrame([{'primary_id': user['primary_id'],
+                                    'last_name': user.get('last_name'),
+                                    'first_name': user.get('first_name')} for user in users])
+
+        is_matching = match_names(row_keys, get_name_keys(candidates))
+
+        return candidates.loc[is_matching, 'primary_id'].tolist(), None
+
+    def release_row(self, last_name_key: str) -> None:
+        """
+        Count a row of a block as returned, the block is dropped after its last row
+        """
+        if last_name_key not in self.block_remaining:
+            return
+
+        self.block_remaining[last_name_key] -= 1
+        if self.block_remaining[last_name_key] <= 0:
+            for blocks in [self.block_remaining, self.block_sizes, self.block_terms, self.block_max_pages,
+                           self.block_searches, self.row_searches]:
+                blocks.pop(last_name_key, None)
+
+    def log_stats(self) -> None:
+        """
+        Log the number of searches and of blocks searched by last name
+        """
+        logging.info(f'Candidate search: {self.nb_searches} searches, '
+                     f'{self.nb_block_searches} blocks searched by last name, '
+                     f'{self.nb_large_blocks} blocks with too many results searched by row')
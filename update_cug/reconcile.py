@@ -0,0 +1,737 @@
+import os
+import logging
+from datetime import date
+from typing import Callable, Dict, List, Optional, Set, Tuple
+import pandas as pd
+from almapiwrapper.analytics import AnalyticsReport
+import config
+from update_cug import alma, tools, update_mediotheken, update_verwaltung
+from update_cug.retry_queue import RetryQueue
+
+# User groups handled by the reconciliation, in order of priority: a user desired
+# in several CUGs receives the first one
+CUG_CODES = [config.MEDIOTHEK_USER_GROUP_CODE, config.VERWALTUNG_USER_GROUP_CODE]
+
+# Name of the workflow in the retry queue
+RETRY_WORKFLOW = 'reconciliation'
+
+# Operations of the reconciliation, in the keys of the retry queue
+ADD = 'add'
+REMOVE = 'remove'
+
+# Columns of the report, the memberships are unknown when the snapshot is not available
+REPORT_DTYPES = {'date': str,
+                 'user_group': str,
+                 'dry_run': bool,
+                 'nb_desired': 'Int64',
+                 'nb_actual': 'Int64',
+                 'nb_added': int,
+                 'nb_removed': int,
+                 'nb_errors': int}
+REPORT_COLUMNS = list(REPORT_DTYPES)
+
+
+def workflow(cug_codes: Optional[List[str]] = None,
+             dry_run: bool = config.RECONCILIATION_DRY_RUN,
+             retry_queue: Optional[RetryQueue] = None) -> Optional[str]:
+    """
+    Reconcile the CUGs: the desired membership of each CUG is built from the sources, the actual
+    membership from one Analytics snapshot. The users missing in a CUG receive it, the users who
+    should not have it anymore are reverted to the user group of their NZ account.
+
+    If the snapshot is not available, the Verwaltung CUG is only added to the users of the
+    Verwaltung Analytics report, no user is removed.
+
+    A dry run doesn't write any file: the plans and the report are only logged.
+
+    Parameters
+    ----------
+    cug_codes: List[str], optional
+        User groups to reconcile, by default all the user groups of CUG_CODES
+    dry_run: bool
+        If True, the plans are only logged and no user is updated
+    retry_queue: RetryQueue, optional
+        Queue of the failed operations, if not provided the queue is loaded and saved by the workflow
+
+    Returns
+    -------
+    Optional[str]
+        string containing the report data, None for a dry run
+    """
+    if cug_codes is None:
+        cug_codes = CUG_CODES
+
+    save_retry_queue = retry_queue is None
+    if retry_queue is None:
+        retry_queue = RetryQueue()
+
+    snapshot = fetch_membership_snapshot()
+
+    # Avoid critical error if the report is not found: without actual membership, only the adds
+    # of the Verwaltung report are possible
+    if snapshot is None:
+        logging.error('Membership snapshot not available => reconciliation SKIPPED, no user removed')
+        results = list()
+        if config.VERWALTUNG_USER_GROUP_CODE in cug_codes:
+            results = add_verwaltung_users(dry_run, retry_queue)
+    else:
+        results = reconcile_cugs(snapshot, cug_codes, dry_run, retry_queue)
+
+    if dry_run is True:
+        report = build_report_rows(results, dry_run).to_markdown(index=False)
+        logging.info(f'DRY RUN reconciliation report:\n{report}')
+        return None
+
+    if config.VERWALTUNG_USER_GROUP_CODE in cug_codes:
+        update_verwaltung.update_report([pid for result in results
+                                         if result['user_group'] == config.VERWALTUNG_USER_GROUP_CODE
+                                         for pid in result['added']])
+
+    if save_retry_queue is True:
+        retry_queue.save()
+
+    return update_report(results, dry_run)
+
+
+def reconcile_cugs(snapshot: pd.DataFrame,
+                   cug_codes: List[str],
+                   dry_run: bool,
+                   retry_queue: RetryQueue) -> List[Dict]:
+    """
+    Build and apply the add and remove plans of the CUGs from the membership snapshot
+
+    Parameters
+    ----------
+    snapshot: pd.DataFrame
+        Membership snapshot
+    cug_codes: List[str]
+        User groups to reconcile
+    dry_run: bool
+        If True, the plans are only logged
+    retry_queue: RetryQueue
+        Queue of the failed operations
+
+    Returns
+    -------
+    List[Dict]
+        Result of the reconciliation of each CUG
+    """
+    # Without current state table, the matching of the Mediotheken users is unknown
+    if os.path.isfile(config.PATH_TO_DATA_CURRENT_STATE):
+        df_current_state = load_current_state()
+    else:
+        logging.warning('No current state table -> desired membership of Mediotheken CUG unknown.')
+        df_current_state = None
+
+    desired = build_desired_membership(snapshot, df_current_state)
+    actual = build_actual_membership(snapshot)
+    protected = build_protected_members(snapshot, df_current_state)
+
+    # Only the matched users who left the list lose the Mediotheken CUG, users who have the CUG
+    # without being matched, like skipped rows without primary ID, keep it
+    departed = update_mediotheken.load_departed_members()
+    removable = {config.MEDIOTHEK_USER_GROUP_CODE: departed}
+
+    results = list()
+    for cug_code in cug_codes:
+        if cug_code not in desired:
+            logging.error(f'{cug_code}: no desired membership available => reconciliation SKIPPED')
+            continue
+
+        to_add, to_remove = build_plans(cug_code, desired, actual, protected, removable.get(cug_code))
+
+        # Failed operations are not retried before the next eligible time
+        to_add = filter_eligible(cug_code, ADD, to_add, retry_queue)
+        to_remove = filter_eligible(cug_code, REMOVE, to_remove, retry_queue)
+
+        result = apply_plans(cug_code, to_add, to_remove, dry_run, retry_queue)
+        result['nb_desired'] = len(desired[cug_code])
+        result['nb_actual'] = len(actual[cug_code])
+        results.append(result)
+
+        # Departed users are kept until they lost the CUG
+        if cug_code == config.MEDIOTHEK_USER_GROUP_CODE and dry_run is False:
+            remaining = build_remaining_departed(departed, desired, actual, protected, result['removed'])
+            if remaining != departed:
+                update_mediotheken.save_departed_members(remaining)
+
+    return results
+
+
+def add_verwaltung_users(dry_run: bool, retry_queue: RetryQueue) -> List[Dict]:
+    """
+    Add the Verwaltung CUG to the users of the Verwaltung Analytics report
+
+    Used when the membership snapshot is not available: users are only added.
+
+    Parameters
+    ----------
+    dry_run: bool
+        If True, the plans are only logged
+    retry_queue: RetryQueue
+        Queue of the failed operations
+
+    Returns
+    -------
+    List[Dict]
+        Result of the Verwaltung CUG, empty list if the report is not available
+    """
+    primary_ids = update_verwaltung.fetch_analytics_report()
+
+    if primary_ids is None:
+        logging.error(f'{config.VERWALTUNG_USER_GROUP_CODE}: Verwaltung report not available => SKIPPED')
+        return []
+
+    to_add = filter_eligible(config.VERWALTUNG_USER_GROUP_CODE, ADD, sorted(set(primary_ids)), retry_queue)
+    result = apply_plans(config.VERWALTUNG_USER_GROUP_CODE, to_add, [], dry_run, retry_queue)
+
+    # Without snapshot, the desired and actual membership are unknown
+    result['nb_desired'] = None
+    result['nb_actual'] = None
+
+    return [result]
+
+
+def build_plans(cug_code: str,
+                desired: Dict[str, Set[str]],
+                actual: Dict[str, Set[str]],
+                protected: Set[str],
+                removable: Optional[Set[str]] = None) -> Tuple[List[str], List[str]]:
+    """
+    Build the add and remove plans of one CUG
+
+    Users desired in an other CUG are not removed, they receive the other CUG with its
+    add plan. Protected users are never removed. If provided, only the removable users
+    can be removed.
+
+    Parameters
+    ----------
+    cug_code: str
+        User group code of the CUG
+    desired: Dict[str, Set[str]]
+        Desired membership of the CUGs, see `build_desired_membership`
+    actual: Dict[str, Set[str]]
+        Actual membership of the CUGs, see `build_actual_membership`
+    protected: Set[str]
+        Users whose CUG must never be removed, see `build_protected_members`
+    removable: Set[str], optional
+        Users who can lose the CUG, by default all the actual members
+
+    Returns
+    -------
+    Tuple[List[str], List[str]]
+        Sorted primary IDs of the users to add and of the users to remove
+    """
+    other_desired = set().union(*[desired[code] for code in desired if code != cug_code])
+
+    to_add = sorted(desired[cug_code] - actual[cug_code])
+    to_remove = actual[cug_code] - desired[cug_code] - other_desired - protected
+    if removable is not None:
+        to_remove &= removable
+
+    return to_add, sorted(to_remove)
+
+
+def build_remaining_departed(departed: Set[str],
+                             desired: Dict[str, Set[str]],
+                             actual: Dict[str, Set[str]],
+                             protected: Set[str],
+                             removed: List[str]) -> Set[str]:
+    """
+    Build the set of the departed Mediotheken users whose CUG must still be removed
+
+    Users without the CUG, removed in this run, back in the list or protected are not
+    kept. Users not removed because of the limit or of an error are removed in the next runs.
+
+    Parameters
+    ----------
+    departed: Set[str]
+        Matched users who left the Mediotheken list, see `update_mediotheken.load_departed_members`
+    desired: Dict[str, Set[str]]
+        Desired membership of the CUGs, see `build_desired_membership`
+    actual: Dict[str, Set[str]]
+        Actual membership of the CUGs, see `build_actual_membership`
+    protected: Set[str]
+        Users whose CUG must never be removed, see `build_protected_members`
+    removed: List[str]
+        Users who lost the CUG in this run
+
+    Returns
+    -------
+    Set[str]
+        Set of primary IDs
+    """
+    all_desired = set().union(*desired.values())
+
+    return (departed & actual[config.MEDIOTHEK_USER_GROUP_CODE]) - all_desired - protected - set(removed)
+
+
+def get_retry_key(primary_id: str, cug_code: str, operation: str) -> str:
+    """
+    Return the key of an operation of the reconciliation in the retry queue
+
+    A failed operation only blocks the same operation on the same CUG, not the other operations of the user.
+
+    Parameters
+    ----------
+    primary_id: str
+        Primary ID of the user
+    cug_code: str
+        User group code of the CUG
+    operation: str
+        ADD or REMOVE
+
+    Returns
+    -------
+    str
+        Key "cug_code|operation|primary_id"
+    """
+    return f'{cug_code}|{operation}|{primary_id}'
+
+
+def filter_eligible(cug_code: str, operation: str, primary_ids: List[str], retry_queue: RetryQueue) -> List[str]:
+    """
+    Remove the users whose operation failed and is not eligible for retry yet
+
+    Parameters
+    ----------
+    cug_code: str
+        User group code of the CUG
+    operation: str
+        ADD or REMOVE
+    primary_ids: List[str]
+        Primary IDs of the users
+    retry_queue: RetryQueue
+        Queue of the failed operations
+
+    Returns
+    -------
+    List[str]
+        Primary IDs of the eligible users
+    """
+    eligible = [pid for pid in primary_ids
+                if retry_queue.is_eligible(RETRY_WORKFLOW, get_retry_key(pid, cug_code, operation))]
+
+    if len(eligible) < len(primary_ids):
+        logging.info(f'{cug_code}: {len(primary_ids) - len(eligible)} users to {operation} not eligible for retry')
+
+    return eligible
+
+
+def fetch_membership_snapshot() -> Optional[pd.DataFrame]:
+    """
+    Fetch the Analytics snapshot of the users having one of the CUGs or an ag.ch email address
+
+    All the email columns of the report are read, like the Verwaltung report a user with an
+    ag.ch address which is not the preferred one must keep the CUG.
+
+    Returns
+    -------
+    Optional[pd.DataFrame]
+        Snapshot with columns primary_id, user_group and email, one row per email address of
+        the users. None if the report is not available
+    """
+
+    # A configured analytics read-only key is required
+    report = AnalyticsReport(config.MEMBERSHIP_ANALYTICS_REPORT_PATH,
+                             config.IZ)
+
+    data = report.data
+
+    if report.error is True or data is None:
+        return None
+
+    return build_snapshot(data)
+
+
+def build_snapshot(data: pd.DataFrame) -> pd.DataFrame:
+    """
+    Build the membership snapshot from the data of the Analytics report
+
+    Parameters
+    ----------
+    data: pd.DataFrame
+        Data of the report with columns Primary Identifier, User Group Code and one or
+        several email columns, like Preferred Email or Email Address
+
+    Returns
+    -------
+    pd.DataFrame
+        Snapshot with columns primary_id, user_group and email, one row per email address of
+        the users
+    """
+    email_columns = [column for column in data.columns if 'email' in column.lower()]
+
+    snapshot = (data[['Primary Identifier', 'User Group Code'] + email_columns]
+                .melt(id_vars=['Primary Identifier', 'User Group Code'], value_vars=email_columns,
+                      value_name='email')
+                .drop(columns='variable'))
+    snapshot.columns = ['primary_id', 'user_group', 'email']
+    snapshot['primary_id'] = snapshot['primary_id'].astype(str).str.strip()
+    snapshot['user_group'] = snapshot['user_group'].fillna('').astype(str)
+    snapshot['email'] = snapshot['email'].fillna('').astype(str).str.strip()
+    snapshot = snapshot.drop_duplicates(ignore_index=True)
+
+    logging.info(f'Membership snapshot loaded: {snapshot["primary_id"].nunique()} users')
+
+    return snapshot
+
+
+def build_desired_membership(snapshot: pd.DataFrame,
+                             df_current_state: Optional[pd.DataFrame]) -> Dict[str, Set[str]]:
+    """
+    Build the set of primary IDs of the users who must have each CUG
+
+    A CUG whose source is not available is missing in the result. A user desired in
+    several CUGs is only kept in the CUG with the highest priority.
+
+    Parameters
+    ----------
+    snapshot: pd.DataFrame
+        Membership snapshot
+    df_current_state: pd.DataFrame, optional
+        Current state data of the Mediotheken users, None if not available
+
+    Returns
+    -------
+    Dict[str, Set[str]]
+        Dictionary with user group code as key and set of primary IDs as value
+    """
+    desired = dict()
+
+    if df_current_state is not None:
+        desired[config.MEDIOTHEK_USER_GROUP_CODE] = update_mediotheken.get_desired_members(df_current_state)
+
+    desired[config.VERWALTUNG_USER_GROUP_CODE] = update_verwaltung.get_desired_members(snapshot)
+
+    # Keep each user only in the CUG with the highest priority. If the source of a CUG
+    # is missing, its actual members keep it and are not added to the other CUGs
+    assigned = set()
+    for cug_code in CUG_CODES:
+        if cug_code in desired:
+            desired[cug_code] -= assigned
+            assigned |= desired[cug_code]
+        else:
+            assigned |= set(snapshot.loc[snapshot['user_group'] == cug_code, 'primary_id'])
+
+    return desired
+
+
+def build_actual_membership(snapshot: pd.DataFrame) -> Dict[str, Set[str]]:
+    """
+    Build the set of primary IDs of the users having each CUG
+
+    Parameters
+    ----------
+    snapshot: pd.DataFrame
+        Membership snapshot
+
+    Returns
+    -------
+    Dict[str, Set[str]]
+        Dictionary with user group code as key and set of primary IDs as value
+    """
+    return {cug_code: set(snapshot.loc[snapshot['user_group'] == cug_code, 'primary_id'])
+            for cug_code in CUG_CODES}
+
+
+def build_protected_members(snapshot: pd.DataFrame, df_current_state: Optional[pd.DataFrame]) -> Set[str]:
+    """
+    Build the set of primary IDs of the users whose CUG must never be removed
+
+    These are the HFGS users and the Mediotheken users flagged as skipped.
+
+    Parameters
+    ----------
+    snapshot: pd.DataFrame
+        Membership snapshot
+    df_current_state: pd.DataFrame, optional
+        Current state data of the Mediotheken users, None if not available
+
+    Returns
+    -------
+    Set[str]
+        Set of primary IDs
+    """
+    protected = set(snapshot.loc[snapshot['user_group'] == config.HFGS_USER_GROUP_CODE, 'primary_id'])
+
+    if df_current_state is not None:
+        protected |= update_mediotheken.get_skipped_members(df_current_state)
+
+    return protected
+
+
+def load_current_state() -> pd.DataFrame:
+    """
+    Load the current state table of the Mediotheken users
+
+    Returns
+    -------
+    pd.DataFrame
+        Current state data
+    """
+    df_current_state = tools.decrypt_data(config.PATH_TO_DATA_CURRENT_STATE, dtype=update_mediotheken.STATE_DTYPES)
+
+    return update_mediotheken.clean_current_state_table_col_types(df_current_state)
+
+
+def apply_plans(cug_code: str,
+                to_add: List[str],
+                to_remove: List[str],
+                dry_run: bool,
+                retry_queue: RetryQueue) -> Dict:
+    """
+    Apply the add and remove plans of one CUG
+
+    Plans above the safety thresholds are limited: only the first RECONCILIATION_MAX_ADDS users
+    are added and the first RECONCILIATION_MAX_REMOVALS users removed, the next ones in the next runs.
+
+    Parameters
+    ----------
+    cug_code: str
+        User group code of the CUG
+    to_add: List[str]
+        Primary IDs of the users who must receive the CUG
+    to_remove: List[str]
+        Primary IDs of the users who must lose the CUG
+    dry_run: bool
+        If True, the plans are only logged
+    retry_queue: RetryQueue
+        Queue where failed operations are recorded
+
+    Returns
+    -------
+    Dict
+        Result of the reconciliation of the CUG
+    """
+    logging.info(f'{cug_code}: {len(to_add)} users to add, {len(to_remove)} users to remove')
+
+    if len(to_add) > config.RECONCILIATION_MAX_ADDS:
+        logging.warning(f'{cug_code}: more than {config.RECONCILIATION_MAX_ADDS} users to add, '
+                        f'only the first ones are processed')
+        to_add = to_add[:config.RECONCILIATION_MAX_ADDS]
+
+    if len(to_remove) > config.RECONCILIATION_MAX_REMOVALS:
+        logging.warning(f'{cug_code}: more than {config.RECONCILIATION_MAX_REMOVALS} users to remove, '
+                        f'only the first ones are processed')
+        to_remove = to_remove[:config.RECONCILIATION_MAX_REMOVALS]
+
+    result = {'user_group': cug_code, 'added': [], 'removed': [], 'failed': []}
+
+    if dry_run is True:
+        for primary_id in to_add:
+            logging.info(f'DRY RUN {cug_code}: {primary_id} would receive the user group')
+        for primary_id in to_remove:
+            logging.info(f'DRY RUN {cug_code}: {primary_id} would lose the user group')
+        result['added'] = to_add
+        result['removed'] = to_remove
+        return result
+
+    for action, primary_ids, done in [(add_user_group, to_add, result['added']),
+                                      (remove_user_group, to_remove, result['removed'])]:
+        for batch_done, batch_failed in apply_in_batches(action, primary_ids, cug_code, retry_queue):
+            done += batch_done
+            result['failed'] += batch_failed
+
+    return result
+
+
+def apply_in_batches(action: Callable[[str, str, RetryQueue], bool],
+                     primary_ids: List[str],
+                     cug_code: str,
+                     retry_queue: RetryQueue):
+    """
+    Apply the action to the users by batches of RECONCILIATION_BATCH_SIZE users
+
+    Parameters
+    ----------
+    action: Callable[[str, str, RetryQueue], bool]
+        Function called with the primary ID, the user group code and the retry queue,
+        returns False in case of error
+    primary_ids: List[str]
+        Primary IDs of the users to process
+    cug_code: str
+        User group code of the CUG
+    retry_queue: RetryQueue
+        Queue where failed operations are recorded
+
+    Returns
+    -------
+    Iterator[Tuple[List[str], List[str]]]
+        For each batch, list of processed primary IDs and list of primary IDs in error
+    """
+    batch_size = config.RECONCILIATION_BATCH_SIZE
+    nb_batches = (len(primary_ids) + batch_size - 1) // batch_size
+
+    for batch_number, start in enumerate(range(0, len(primary_ids), batch_size), start=1):
+        done = []
+        failed = []
+        for primary_id in primary_ids[start:start + batch_size]:
+            if action(primary_id, cug_code, retry_queue) is True:
+                done.append(primary_id)
+            else:
+                failed.append(primary_id)
+
+        logging.info(f'{cug_code}: {action.__name__} batch {batch_number} / {nb_batches} done, '
+                     f'{len(done)} processed, {len(failed)} errors')
+        yield done, failed
+
+
+def add_user_group(primary_id: str, cug_code: str, retry_queue: RetryQueue) -> bool:
+    """
+    Set the user group of the user
+
+    Parameters
+    ----------
+    primary_id: str
+        Primary ID of the user
+    cug_code: str
+        User group code of the CUG
+    retry_queue: RetryQueue
+        Queue where failed operations are recorded
+
+    Returns
+    -------
+    bool
+        False in case of error
+    """
+    key = get_retry_key(primary_id, cug_code, ADD)
+    user, error_msg = alma.fetch_user(primary_id)
+
+    if error_msg is not None:
+        retry_queue.record_failure(RETRY_WORKFLOW, key, 'get', error_msg)
+        return False
+
+    # Snapshot of Analytics can be older than the last update
+    if user.data['user_group']['value'] == cug_code:
+        logging.info(f'{primary_id}: user group already "{cug_code}"')
+        retry_queue.record_success(RETRY_WORKFLOW, key)
+        return True
+
+    user.data['user_group']['value'] = cug_code
+
+    # Update user, override is required to update user group if there is already a user group change on the account
+    user, error_msg = alma.update_user(user, override=['user_group'])
+
+    if error_msg is not None:
+        logging.error(f'{primary_id}: error updating user group')
+        retry_queue.record_failure(RETRY_WORKFLOW, key, 'put', error_msg)
+        return False
+
+    logging.info(f'{primary_id}: user group updated to "{cug_code}"')
+    retry_queue.record_success(RETRY_WORKFLOW, key)
+    return True
+
+
+def remove_user_group(primary_id: str, cug_code: str, retry_queue: RetryQueue) -> bool:
+    """
+    Revert the user group of the user to the user group of the NZ account
+
+    Parameters
+    ----------
+    primary_id: str
+        Primary ID of the user
+    cug_code: str
+        User group code of the CUG to remove
+    retry_queue: RetryQueue
+        Queue where failed operations are recorded
+
+    Returns
+    -------
+    bool
+        False in case of error
+    """
+    key = get_retry_key(primary_id, cug_code, REMOVE)
+    user, error_msg = alma.fetch_user(primary_id)
+
+    if error_msg is not None:
+        retry_queue.record_failure(RETRY_WORKFLOW, key, 'get', error_msg)
+        return False
+
+    # Snapshot of Analytics can be older than the last update
+    if user.data['user_group']['value'] != cug_code:
+        logging.info(f'{primary_id}: user group already not "{cug_code}"')
+        retry_queue.record_success(RETRY_WORKFLOW, key)
+        return True
+
+    # The email addresses of the snapshot can be incomplete or older than the account
+    if cug_code == config.VERWALTUNG_USER_GROUP_CODE and update_verwaltung.has_ag_ch_email(user.data):
+        logging.warning(f'{primary_id}: ag.ch email address in the account, user group "{cug_code}" kept')
+        retry_queue.record_success(RETRY_WORKFLOW, key)
+        return True
+
+    nz_user, error_msg = alma.fetch_user(primary_id, zone='NZ')
+
+    if error_msg is not None:
+        logging.error(f'{primary_id}: no NZ account, impossible to revert user group "{cug_code}"')
+        retry_queue.record_failure(RETRY_WORKFLOW, key, 'get', error_msg)
+        return False
+
+    user.data['user_group'] = nz_user.data['user_group']
+
+    # No override: the user group is synchronized again with the NZ account
+    user, error_msg = alma.update_user(user)
+
+    if error_msg is not None:
+        logging.error(f'{primary_id}: error reverting user group')
+        retry_queue.record_failure(RETRY_WORKFLOW, key, 'put', error_msg)
+        return False
+
+    logging.info(f'{primary_id}: user group reverted from "{cug_code}" to "{user.data["user_group"]["value"]}"')
+    retry_queue.record_success(RETRY_WORKFLOW, key)
+    return True
+
+
+def build_report_rows(results: List[Dict], dry_run: bool) -> pd.DataFrame:
+    """
+    Build the rows of the report of the reconciliation
+
+    Parameters
+    ----------
+    results: List[Dict]
+        Result of the reconciliation of each CUG
+    dry_run: bool
+        True if the plans have only been logged
+
+    Returns
+    -------
+    pd.DataFrame
+        One row for each CUG
+    """
+    return pd.DataFrame([{'date': date.today().isoformat(),
+                          'user_group': result['user_group'],
+                          'dry_run': dry_run,
+                          'nb_desired': result['nb_desired'],
+                          'nb_actual': result['nb_actual'],
+                          'nb_added': len(result['added']),
+                          'nb_removed': len(result['removed']),
+                          'nb_errors': len(result['failed'])} for result in results],
+                        columns=REPORT_COLUMNS).astype(REPORT_DTYPES)
+
+
+def update_report(results: List[Dict], dry_run: bool) -> str:
+    """
+    Write the report of the reconciliation
+
+    Parameters
+    ----------
+    results: List[Dict]
+        Result of the reconciliation of each CUG
+    dry_run: bool
+        True if the plans have only been logged
+
+    Returns
+    -------
+    str
+        string containing the report data
+    """
+    if os.path.isfile(config.PATH_TO_REPORT_RECONCILIATION):
+        df = pd.read_csv(config.PATH_TO_REPORT_RECONCILIATION, dtype=REPORT_DTYPES)
+    else:
+        df = pd.DataFrame(columns=REPORT_COLUMNS).astype(REPORT_DTYPES)
+
+    df = pd.concat([df, build_report_rows(results, dry_run)], ignore_index=True)
+
+    df.to_csv(config.PATH_TO_REPORT_RECONCILIATION, index=False)
+
+    return df.tail(5).to_markdown(index=False)
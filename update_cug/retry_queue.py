@@ -0,0 +1,222 @@
+import os
+import logging
+from datetime import datetime, timedelta
+from typing import Optional
+import pandas as pd
+import config
+from update_cug import tools
+
+TRANSIENT = 'transient'
+PERMANENT = 'permanent'
+
+# Lower case fragments of the error messages of failures worth to be retried. Other errors,
+# like a user not found or a rejected update, will fail again with the same data. Network
+# errors exit almapiwrapper, they are reported as 'no response' by `alma.call_once`.
+TRANSIENT_ERROR_PATTERNS = ['unknown error',
+                            'no response',
+                            'http 429',
+                            'http 5',
+                            'internal server error',
+                            'unavailable',
+                            'try again',
+                            'concurrent',
+                            'locked']
+
+QUEUE_COLUMNS = ['workflow', 'key', 'operation', 'error_class', 'error_msg',
+                 'attempts', 'first_failure', 'next_eligible']
+
+
+def classify_error(error_msg: str) -> str:
+    """Classify the error of an Alma operation
+
+    Parameters
+    ----------
+    error_msg: str
+        Error message of the operation
+
+    Returns
+    -------
+    str
+        'transient' if the operation can succeed when retried, 'permanent' else
+    """
+    error_msg = error_msg.lower()
+
+    if any(pattern in error_msg for pattern in TRANSIENT_ERROR_PATTERNS):
+        return TRANSIENT
+
+    return PERMANENT
+
+
+class RetryQueue:
+    """
+    Class to handle the persistent queue of the failed Alma operations
+
+    Each entry is identified by the workflow and a key, the CUG, operation and primary ID of
+    the user or the key of the row of the source list. Transient errors get a next eligible time, doubled
+    after each failed run. Permanent errors and entries failing too many times are moved
+    to the dead letter file and are not retried anymore.
+
+    Both files are encrypted and stored in the git repository.
+
+    Attributes:
+    -----------
+    file_path: str
+        The path of the encrypted queue
+    dead_letter_path: str
+        The path of the encrypted dead letter file
+    queue: pd.DataFrame
+        The entries to retry
+    dead_letter: pd.DataFrame
+        The entries not retried anymore
+    """
+    def __init__(self, file_path: str = config.PATH_TO_RETRY_QUEUE,
+                 dead_letter_path: str = config.PATH_TO_RETRY_DEAD_LETTER):
+        self.file_path = file_path
+        self.dead_letter_path = dead_letter_path
+        self.queue = self.load(file_path)
+        self.dead_letter = self.load(dead_letter_path)
+
+    def __len__(self) -> int:
+        return len(self.queue)
+
+    @staticmethod
+    def load(file_path: str) -> pd.DataFrame:
+        """
+        Load an encrypted queue file, an empty queue is returned if the file doesn't exist
+        """
+        if not os.path.isfile(file_path):
+            return pd.DataFrame(columns=QUEUE_COLUMNS)
+
+        # Keys are read as strings, keys looking like numbers keep their leading zeros
+        df = tools.decrypt_data(file_path, dtype=str)
+        df['error_msg'] = df['error_msg'].fillna('')
+        df['attempts'] = df['attempts'].astype(int)
+
+        return df[QUEUE_COLUMNS]
+
+    def save(self) -> None:
+        """
+        Encrypt and write the queue and the dead letter files
+        """
+        tools.encrypt_data(self.queue, self.file_path)
+        tools.encrypt_data(self.dead_letter, self.dead_letter_path)
+        logging.info(f'Retry queue saved: {len(self.queue)} entries to retry, '
+                     f'{len(self.dead_letter)} entries in dead letter')
+
+    def is_eligible(self, workflow: str, key: str) -> bool:
+        """
+        Check if an operation can be done now
+
+        Parameters
+        ----------
+        workflow: str
+            Name of the workflow
+        key: str
+            Key of the entry
+
+        Returns
+        -------
+        bool
+            False if the entry is in the dead letter file or if its next eligible time is not reached
+        """
+        if ((self.dead_letter['workflow'] == workflow) & (self.dead_letter['key'] == key)).any():
+            return False
+
+        entry = self.queue.loc[(self.queue['workflow'] == workflow) & (self.queue['key'] == key)]
+
+        return len(entry) == 0 or entry['next_eligible'].iloc[0] <= datetime.now().isoformat()
+
+    def record_failure(self, workflow: str, key: str, operation: str, error_msg: Optional[str]) -> None:
+        """
+        Add or update the entry of a failed operation
+
+        Parameters
+        ----------
+        workflow: str
+            Name of the workflow
+        key: str
+            Key of the entry
+        operation: str
+            Failed operation: 'search', 'get' or 'put'
+        error_msg: str, optional
+            Error message of the operation
+        """
+        if error_msg is None:
+            error_msg = 'unknown error'
+
+        now = datetime.now()
+        is_entry = (self.queue['workflow'] == workflow) & (self.queue['key'] == key)
+
+        if is_entry.any():
+            entry = self.queue.loc[is_entry].iloc[0].to_dict()
+            self.queue = self.queue.loc[~is_entry].reset_index(drop=True)
+        else:
+            entry = {'workflow': workflow, 'key': key, 'attempts': 0, 'first_failure': now.isoformat()}
+
+        backoff = min(config.RETRY_QUEUE_BACKOFF * 2 ** entry['attempts'], config.RETRY_QUEUE_MAX_BACKOFF)
+        entry.update({'operation': operation,
+                      'error_class': classify_error(error_msg),
+                      'error_msg': error_msg,
+                      'attempts': entry['attempts'] + 1,
+                      'next_eligible': (now + timedelta(hours=backoff)).isoformat()})
+
+        if entry['error_class'] == PERMANENT or entry['attempts'] >= config.RETRY_QUEUE_MAX_ATTEMPTS:
+            logging.error(f'{workflow} {key}: {operation} failed with {entry["error_class"]} error after '
+                          f'{entry["attempts"]} runs, moved to dead letter: {error_msg}')
+            self.dead_letter.loc[len(self.dead_letter)] = entry
+        else:
+            logging.warning(f'{workflow} {key}: {operation} failed with transient error, next try after '
+                            f'{entry["next_eligible"]}: {error_msg}')
+            self.queue.loc[len(self.queue)] = entry
+
+    def record_success(self, workflow: str, key: str) -> None:
+        """
+        Remove the entry of an operation that succeeded
+
+        Parameters
+        ----------
+        workflow: str
+            Name of the workflow
+        key: str
+            Key of the entry
+        """
+        is_entry = (self.queue['workflow'] == workflow) & (self.queue['key'] == key)
+
+        if is_entry.any():
+            self.queue = self.queue.loc[~is_entry].reset_index(drop=True)
+
+    def requeue(self, workflow: Optional[str] = None, key: Optional[str] = None) -> int:
+        """
+        Move entries of the dead letter file back to the queue
+
+        The entries are eligible at once and their attempts start again from zero.
+
+        Parameters
+        ----------
+        workflow: str, optional
+            Name of the workflow, entries of all workflows if not provided
+        key: str, optional
+            Key of the entry, entries of all keys if not provided
+
+        Returns
+        -------
+        int
+            Number of entries moved to the queue
+        """
+        is_entry = pd.Series(True, index=self.dead_letter.index)
+        if workflow is not None:
+            is_entry &= self.dead_letter['workflow'] == workflow
+        if key is not None:
+            is_entry &= self.dead_letter['key'] == key
+
+        entries = self.dead_letter.loc[is_entry].copy()
+        entries['attempts'] = 0
+        entries['next_eligible'] = datetime.now().isoformat()
+
+        if len(entries) > 0:
+            self.queue = pd.concat([self.queue, entries], ignore_index=True)
+            self.dead_letter = self.dead_letter.loc[~is_entry].reset_index(drop=True)
+
+        logging.info(f'{len(entries)} entries of the dead letter requeued')
+
+        return len(entries)
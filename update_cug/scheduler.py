@@ -0,0 +1,189 @@
+import logging
+import os
+import time
+from datetime import date, datetime
+from typing import Dict, List, Optional
+import pandas as pd
+import config
+from update_cug import crypto, http_session, reconcile, tools, update_mediotheken
+from update_cug.gitrepo import GitRepo
+from update_cug.retry_queue import RetryQueue
+
+
+class Scheduler:
+    """
+    Class to run the CUG updates periodically in a long-running process
+
+    The git repository, the decrypted current state table, the API keys and the HTTP
+    session are kept in memory between two cycles. The first cycle of each day is a full run, like the
+    daily cron run: all pending users are checked again, the CUGs are reconciled
+    and the report is sent. The other cycles only process the new rows of the
+    Mediotheken source list, and only if the source list changed.
+
+    The current state table and the retry queue are loaded again when their files
+    have been changed in the remote repository since the last cycle, for example by
+    a reset or a merge of shards.
+
+    Attributes:
+    -----------
+    repo: GitRepo
+        The git repository, kept cloned between two cycles
+    interval: int
+        Number of seconds between the start of two cycles
+    df_current_state: pd.DataFrame
+        The current state table of the last cycle
+    source_digest: str
+        The digest of the source list of the last cycle
+    last_full_cycle: date
+        The date of the last full cycle
+    retry_queue: RetryQueue
+        The queue of the failed operations
+    file_digests: Dict[str, Optional[str]]
+        The digests of the current state table and of the retry queue files after the last cycle
+    """
+    def __init__(self, repo: GitRepo, interval: int):
+        self.repo = repo
+        self.interval = interval
+        self.df_current_state: Optional[pd.DataFrame] = None
+        self.source_digest: Optional[str] = None
+        self.last_full_cycle: Optional[date] = None
+        self.retry_queue: Optional[RetryQueue] = None
+        self.file_digests: Dict[str, Optional[str]] = dict()
+
+    def run(self) -> None:
+        """
+        Run the cycles until the process is interrupted
+        """
+        try:
+            while True:
+                start = time.monotonic()
+                # almapiwrapper and the decryption of the data exit the process on errors,
+                # only the cycle is stopped
+                try:
+                    self.run_cycle()
+                except (Exception, SystemExit) as e:
+                    logging.exception(f'an exception occured during the cycle: {repr(e)}')
+
+                time.sleep(max(0.0, self.interval - (time.monotonic() - start)))
+        finally:
+            self.repo.delete_local_repo()
+
+    def run_cycle(self) -> None:
+        """
+        Run one cycle: update the repository, the CUGs and push the results
+        """
+        self.repo.pull_repo()
+
+        log_file_path = tools.configure_logger()
+        full_cycle = self.last_full_cycle != date.today()
+        logging.info(f'Starting {"full" if full_cycle else "incremental"} cycle at {datetime.now()}')
+
+        # Files changed by other processes are loaded again
+        if self.df_current_state is not None and self.has_changed([config.PATH_TO_DATA_CURRENT_STATE]):
+            logging.warning('Current state table changed in the repository => loaded again')
+            self.df_current_state = None
+
+        if self.retry_queue is not None and self.has_changed([config.PATH_TO_RETRY_QUEUE,
+                                                              config.PATH_TO_RETRY_DEAD_LETTER]):
+            logging.warning('Retry queue changed in the repository => loaded again')
+            self.retry_queue = None
+
+        if self.retry_queue is None:
+            self.retry_queue = RetryQueue()
+
+        # The session and its connections are kept between two cycles
+        http_session.install_session()
+
+        reports = list()
+        files_to_commit = list()
+        report = self.update_mediotheken(full_cycle)
+        if report is not None:
+            reports.append(report)
+            files_to_commit += [config.PATH_TO_DATA_CURRENT_STATE,
+                                config.PATH_TO_DEPARTED_MEMBERS,
+                                config.PATH_TO_REPORT_MEDIOTHEKEN]
+
+        # Analytics data is only refreshed once a day
+        if full_cycle is True:
+            report = reconcile.workflow(retry_queue=self.retry_queue)
+            if report is not None:
+                reports.append(report)
+                files_to_commit += [config.PATH_TO_DEPARTED_MEMBERS,
+                                    config.PATH_TO_REPORT_VERWALTUNG,
+                                    config.PATH_TO_REPORT_RECONCILIATION]
+            if len(reports) > 0:
+                tools.send_report(reports)
+            self.last_full_cycle = date.today()
+
+        if len(reports) > 0:
+            self.retry_queue.save()
+            files_to_commit += [config.PATH_TO_RETRY_QUEUE, config.PATH_TO_RETRY_DEAD_LETTER]
+
+        http_session.log_session_stats()
+        logging.info(f'Cycle ended at {datetime.now()}')
+
+        # Encrypt the data, the plain text log is not kept in the repository
+        files_to_commit.append(crypto.encrypt_log_file(log_file_path))
+        tools.remove_log_file(log_file_path)
+
+        # Push repository to remote
+        self.repo.push_repo(files_to_commit)
+
+        self.file_digests = {file_path: self.get_file_digest(file_path)
+                             for file_path in [config.PATH_TO_DATA_CURRENT_STATE,
+                                               config.PATH_TO_RETRY_QUEUE,
+                                               config.PATH_TO_RETRY_DEAD_LETTER]}
+
+    @staticmethod
+    def get_file_digest(file_path: str) -> Optional[str]:
+        """
+        Return the digest of a file, None if the file doesn't exist
+        """
+        return tools.file_digest(file_path) if os.path.isfile(file_path) else None
+
+    def has_changed(self, file_paths: List[str]) -> bool:
+        """
+        Check if one of the files has changed since the end of the last cycle
+        """
+        return any(self.get_file_digest(file_path) != self.file_digests.get(file_path) for file_path in file_paths)
+
+    def update_mediotheken(self, full_cycle: bool) -> Optional[str]:
+        """
+        Update the CUG of the Mediotheken users
+
+        Parameters
+        ----------
+        full_cycle: bool
+            If True, all the rows of the current state table are processed,
+            else only the new rows of the source list
+
+        Returns
+        -------
+        Optional[str]
+            string containing the report data, None if nothing has been processed
+        """
+        source_digest = tools.file_digest(config.PATH_TO_SOURCE_DATA)
+        if full_cycle is False and source_digest == self.source_digest:
+            logging.info('Source list unchanged since the last cycle => SKIPPED')
+            return None
+
+        df_source = update_mediotheken.load_source_data()
+
+        if self.df_current_state is None:
+            df_current_state = update_mediotheken.load_current_state(df_source)
+            indexes = None
+        else:
+            df_current_state = update_mediotheken.actualize_current_state_table(df_source,
+                                                                                self.df_current_state.copy())
+            indexes = None if full_cycle else update_mediotheken.get_new_rows(df_current_state,
+                                                                              self.df_current_state)
+            logging.info(f'Current state table kept from the last cycle, '
+                         f'{len(df_current_state) if indexes is None else len(indexes)} rows to process.')
+
+        update_mediotheken.process_users(df_current_state, self.retry_queue, indexes)
+        report = update_mediotheken.save_current_state(df_current_state)
+
+        self.df_current_state = df_current_state
+        self.source_digest = source_digest
+
+        return report
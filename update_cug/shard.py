@@ -0,0 +1,240 @@
+import hashlib
+import logging
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from logging.handlers import QueueHandler, QueueListener
+from multiprocessing import get_context
+from queue import Queue
+from typing import List
+import pandas as pd
+import config
+from update_cug import http_session, matching, tools, update_mediotheken
+from update_cug.retry_queue import RetryQueue
+
+
+def get_shard(key: str, nb_shards: int) -> int:
+    """Return the shard of a row of the current state table
+
+    The shard only depends on the last name key of the row, it is the same on all hosts and
+    runs. Rows sharing a last name are in the same shard and are searched together, see
+    `matching.CandidateSearch`.
+
+    Parameters
+    ----------
+    key: str
+        Last name key of the row, see `matching.normalize_names`
+    nb_shards: int
+        Number of shards
+
+    Returns
+    -------
+    int
+        Index of the shard, from 0 to nb_shards - 1
+    """
+    return int(hashlib.sha256(key.encode()).hexdigest(), 16) % nb_shards
+
+
+def get_shard_path(file_path: str, index: int, nb_shards: int) -> str:
+    """Return the path of the shard version of a file
+
+    Parameters
+    ----------
+    file_path: str
+        Path of the merged file
+    index: int
+        Index of the shard
+    nb_shards: int
+        Number of shards
+
+    Returns
+    -------
+    str
+        Path of the file of the shard
+    """
+    base, extension = os.path.splitext(file_path)
+    return f'{base}_shard_{index}_of_{nb_shards}{extension}'
+
+
+def get_shard_paths(nb_shards: int) -> List[str]:
+    """Return the paths of all the files written by the shards
+
+    Parameters
+    ----------
+    nb_shards: int
+        Number of shards
+
+    Returns
+    -------
+    List[str]
+        Paths of the current state tables, retry queues and dead letter files of the shards
+    """
+    return [get_shard_path(file_path, index, nb_shards)
+            for index in range(nb_shards)
+            for file_path in [config.PATH_TO_DATA_CURRENT_STATE,
+                              config.PATH_TO_RETRY_QUEUE,
+                              config.PATH_TO_RETRY_DEAD_LETTER]]
+
+
+def process_shard(index: int, nb_shards: int) -> None:
+    """Process the rows of the current state table belonging to one shard
+
+    The rows of the shard and the retry queue entries of these rows are written in
+    encrypted shard files, they are merged with `merge_shards`.
+
+    Parameters
+    ----------
+    index: int
+        Index of the shard to process
+    nb_shards: int
+        Number of shards
+    """
+    df_source = update_mediotheken.load_source_data()
+    df_current_state = update_mediotheken.load_current_state(df_source)
+
+    last_name_keys = matching.normalize_names(df_current_state['last_name'])
+    indexes = df_current_state.index[last_name_keys.map(lambda key: get_shard(key, nb_shards)) == index]
+    logging.info(f'Shard {index} / {nb_shards}: {len(indexes)} rows to process')
+
+    # Only the entries of the rows of the shard are kept, entries of other workflows stay in the main queue.
+    # The last name is the first part of the keys of the entries, see `update_mediotheken.get_row_key`
+    retry_queue = RetryQueue()
+    for attribute in ['queue', 'dead_letter']:
+        entries = getattr(retry_queue, attribute)
+        last_name_keys = matching.normalize_names(entries['key'].str.split('|').str[0])
+        is_in_shard = ((entries['workflow'] == update_mediotheken.RETRY_WORKFLOW)
+                       & (last_name_keys.map(lambda key: get_shard(key, nb_shards)) == index))
+        setattr(retry_queue, attribute, entries.loc[is_in_shard].reset_index(drop=True))
+    retry_queue.file_path = get_shard_path(config.PATH_TO_RETRY_QUEUE, index, nb_shards)
+    retry_queue.dead_letter_path = get_shard_path(config.PATH_TO_RETRY_DEAD_LETTER, index, nb_shards)
+
+    update_mediotheken.process_users(df_current_state, retry_queue, indexes)
+
+    tools.encrypt_data(df_current_state.loc[indexes],
+                       get_shard_path(config.PATH_TO_DATA_CURRENT_STATE, index, nb_shards))
+    retry_queue.save()
+
+    http_session.log_session_stats()
+
+
+def run_shard(index: int, nb_shards: int) -> None:
+    """Process one shard in a worker process, see `process_shard`
+
+    almapiwrapper and the decryption of the data exit the process on errors. The exit
+    is turned into an exception, so the main process knows that the shard failed.
+
+    Parameters
+    ----------
+    index: int
+        Index of the shard to process
+    nb_shards: int
+        Number of shards
+    """
+    try:
+        process_shard(index, nb_shards)
+    except SystemExit as e:
+        raise RuntimeError(f'shard {index} / {nb_shards} exited with code {e.code}') from None
+
+
+def merge_shards(nb_shards: int) -> str:
+    """Merge the files of the shards into the current state table, the report and the retry queue
+
+    The rows are in the order of the source list, the result doesn't depend on the order in which
+    the shards have been processed. The shard files are removed after the merge.
+
+    Parameters
+    ----------
+    nb_shards: int
+        Number of shards
+
+    Returns
+    -------
+    str
+        string containing the report data
+    """
+    missing_paths = [path for path in get_shard_paths(nb_shards) if not os.path.isfile(path)]
+    if len(missing_paths) > 0:
+        logging.critical(f'Missing shard files, merge impossible: {", ".join(missing_paths)}')
+        sys.exit(1)
+
+    df_source = update_mediotheken.load_source_data()
+    df_shards = pd.concat([tools.decrypt_data(get_shard_path(config.PATH_TO_DATA_CURRENT_STATE, index, nb_shards),
+                                              dtype=update_mediotheken.STATE_DTYPES)
+                           for index in range(nb_shards)],
+                          ignore_index=True)
+    df_current_state = update_mediotheken.actualize_current_state_table(df_source, df_shards)
+
+    retry_queue = RetryQueue()
+    shard_retry_queues = [RetryQueue(get_shard_path(config.PATH_TO_RETRY_QUEUE, index, nb_shards),
+                                     get_shard_path(config.PATH_TO_RETRY_DEAD_LETTER, index, nb_shards))
+                          for index in range(nb_shards)]
+    for attribute in ['queue', 'dead_letter']:
+        entries = getattr(retry_queue, attribute)
+        entries = entries.loc[entries['workflow'] != update_mediotheken.RETRY_WORKFLOW]
+        setattr(retry_queue, attribute,
+                pd.concat([entries] + [getattr(queue, attribute) for queue in shard_retry_queues],
+                          ignore_index=True))
+    retry_queue.save()
+
+    for path in get_shard_paths(nb_shards):
+        os.remove(path)
+
+    logging.info(f'{nb_shards} shards merged: {len(df_current_state)} rows')
+
+    return update_mediotheken.save_current_state(df_current_state)
+
+
+def run_workers(nb_workers: int) -> str:
+    """Process the Mediotheken list with one worker process for each shard and merge the results
+
+    Each worker has its own API session. The logs of the workers are sent to the
+    handlers of the main process. If a worker fails or is killed, the shards are not
+    merged and the process exits.
+
+    Parameters
+    ----------
+    nb_workers: int
+        Number of worker processes and shards
+
+    Returns
+    -------
+    str
+        string containing the report data
+    """
+    context = get_context('spawn')
+
+    with context.Manager() as manager:
+        log_queue = manager.Queue()
+        listener = QueueListener(log_queue, *logging.root.handlers, respect_handler_level=True)
+        listener.start()
+        try:
+            with ProcessPoolExecutor(nb_workers, mp_context=context,
+                                     initializer=init_worker, initargs=(log_queue,)) as executor:
+                futures = [executor.submit(run_shard, index, nb_workers) for index in range(nb_workers)]
+                errors = [repr(future.exception()) for future in futures if future.exception() is not None]
+        finally:
+            listener.stop()
+
+    if len(errors) > 0:
+        logging.critical(f'Workers failed, shards not merged: {", ".join(errors)}')
+        sys.exit(1)
+
+    return merge_shards(nb_workers)
+
+
+def init_worker(log_queue: Queue) -> None:
+    """Configure the logger of a worker process to send the records to the main process
+    and install the HTTP session of the worker
+
+    Parameters
+    ----------
+    log_queue: Queue
+        Queue read by the listener of the main process
+    """
+    # The records are formatted by the handlers of the main process
+    logging.basicConfig(level=logging.INFO,
+                        format='%(message)s',
+                        handlers=[QueueHandler(log_queue)],
+                        force=True)
+
+    http_session.install_session()
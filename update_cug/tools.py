@@ -1,15 +1,13 @@
+import hashlib
 import logging
 import os
 import sys
 from datetime import date, datetime
 import config
-from cryptography.fernet import Fernet
 import pandas as pd
 from io import BytesIO
-from typing import List
-
-# sendmail is a custom local package
-from sendmail import sendmail
+from typing import Iterable, Iterator, List, Optional
+from update_cug.crypto import decrypt_file, get_cipher_suite
 
 
 def configure_logger() -> str:
@@ -43,7 +41,22 @@ def close_loggers() -> None:
     logging.shutdown()
 
 
-def decrypt_data(file_path) -> pd.DataFrame:
+def remove_log_file(log_file_path: str) -> None:
+    """
+    Close the handlers writing in the log file and remove it
+
+    The next records are only written in the console.
+    """
+    for handler in logging.root.handlers[:]:
+        if isinstance(handler, logging.FileHandler) and handler.baseFilename == os.path.abspath(log_file_path):
+            logging.root.removeHandler(handler)
+            handler.close()
+
+    if os.path.isfile(log_file_path):
+        os.remove(log_file_path)
+
+
+def decrypt_data(file_path, dtype: Optional[type] = None) -> pd.DataFrame:
     """Decrypt the data from the file and return CSV pandas dataframe
 
     Note:
@@ -51,21 +64,16 @@ def decrypt_data(file_path) -> pd.DataFrame:
         The secret key is stored in the environment variable `abn_slsp_exchange_secret`.
         The file is decrypted and read into a pandas dataframe.
         Separator is ';'.
+        With `dtype=str`, values are not converted, barcodes keep their leading zeros.
     """
     # the data in the repo is encrypted as a second protection
-    # we have to decrypt it first
-    cipher_suite = Fernet(os.getenv('abn_slsp_exchange_secret'))
-
-    with open(file_path, "rb") as encrypted_file:
-        encrypted_data = encrypted_file.read()
-
-    # decrypting into memory
-    decrypted_data = cipher_suite.decrypt(encrypted_data)
+    # we have to decrypt it first, decrypting into memory
+    decrypted_data = decrypt_file(file_path)
 
     # We use BytesIO to feed data in memory into pd
     data_stream = BytesIO(decrypted_data)
     try:
-        df = pd.read_csv(data_stream, sep=';')
+        df = pd.read_csv(data_stream, sep=';', dtype=dtype)
         return df
 
     except pd.errors.ParserError:
@@ -73,6 +81,34 @@ def decrypt_data(file_path) -> pd.DataFrame:
         sys.exit(1)
 
 
+def iter_decrypt_data(file_path: str, chunk_size: int, dtype: Optional[type] = None) -> Iterator[pd.DataFrame]:
+    """Decrypt the data from the file and return it as CSV pandas dataframes of chunk_size rows
+
+    Note:
+        The file is decrypted at once, see `crypto.decrypt_file`, but only chunk_size rows
+        are parsed at a time, see `read_data_chunks`.
+    """
+    try:
+        yield from read_data_chunks(decrypt_file(file_path), chunk_size, dtype)
+
+    except pd.errors.ParserError:
+        logging.error(f'Error reading file {file_path}.')
+        sys.exit(1)
+
+
+def read_data_chunks(data: bytes, chunk_size: int, dtype: Optional[type] = None) -> Iterator[pd.DataFrame]:
+    """Read decrypted CSV data as pandas dataframes of chunk_size rows
+
+    Note:
+        The data can be read several times without decrypting the file again.
+        Separator is ';'. Empty data has no chunk.
+    """
+    if len(data.strip()) == 0:
+        return
+
+    yield from pd.read_csv(BytesIO(data), sep=';', dtype=dtype, chunksize=chunk_size)
+
+
 def encrypt_data(data: pd.DataFrame, file_path: str) -> None:
     """Encrypt the data and write to the file
 
@@ -81,7 +117,7 @@ def encrypt_data(data: pd.DataFrame, file_path: str) -> None:
         The secret key is stored in the environment variable `abn_slsp_exchange_secret`.
         The file is encrypted and written to the file.
     """
-    cipher_suite = Fernet(os.getenv('abn_slsp_exchange_secret'))
+    cipher_suite = get_cipher_suite()
     data_stream = BytesIO()
     data.to_csv(data_stream, sep=';', index=False)
     data_stream.seek(0)
@@ -91,48 +127,47 @@ def encrypt_data(data: pd.DataFrame, file_path: str) -> None:
         encrypted_file.write(encrypted_data)
 
 
-def decrypt_log_file(log_file_path: str) -> str:
-    """Decrypt the log file and return the decrypted file path
+def encrypt_data_chunks(chunks: Iterable[pd.DataFrame], file_path: str, columns: List[str]) -> None:
+    """Encrypt the data chunk by chunk and write to the file
 
     Note:
-        The data is encrypted using Fernet encryption algorithm.
-        The secret key is stored in the environment variable `abn_slsp_exchange_secret`.
-        The file is decrypted and written to the file.
+        Each chunk is converted to CSV as soon as it is available, only the CSV data is kept
+        in memory, not the chunks. The data is then encrypted at once, like with `encrypt_data`,
+        the file contains one Fernet token. Without chunk, only the header of `columns` is written.
+        The file is written in a temporary file replacing the file at the end, an interrupted
+        process doesn't leave an incomplete file.
     """
-    cipher_suite = Fernet(os.getenv('abn_slsp_exchange_secret'))
+    cipher_suite = get_cipher_suite()
+    data_stream = BytesIO()
 
-    with open(log_file_path, "rb") as encrypted_file:
-        encrypted_data = encrypted_file.read()
+    for chunk in chunks:
+        chunk.to_csv(data_stream, sep=';', index=False, header=(data_stream.tell() == 0))
 
-    decrypted_data = cipher_suite.decrypt(encrypted_data)
+    if data_stream.tell() == 0:
+        pd.DataFrame(columns=columns).to_csv(data_stream, sep=';', index=False)
 
-    decrypted_file_path = log_file_path[:-4] + '_decrypted.log'
-    with open(decrypted_file_path, "wb") as decrypted_file:
-        decrypted_file.write(decrypted_data)
+    temp_file_path = f'{file_path}.tmp'
+    with open(temp_file_path, "wb") as encrypted_file:
+        encrypted_file.write(cipher_suite.encrypt(data_stream.getvalue()))
 
-    return decrypted_file_path
+    os.replace(temp_file_path, file_path)
 
 
-def encrypt_log_file(log_file_path: str) -> str:
-    """Encrypt the log file and write to the file
+def file_digest(file_path: str) -> str:
+    """Compute the SHA-256 digest of a file
 
-    Note:
-        The data is encrypted using Fernet encryption algorithm.
-        The secret key is stored in the environment variable `abn_slsp_exchange_secret`.
-        The file is encrypted and written to the file.
-    """
-    cipher_suite = Fernet(os.getenv('abn_slsp_exchange_secret'))
-
-    with open(log_file_path, "rb") as log_file:
-        log_data = log_file.read()
-
-    encrypted_data = cipher_suite.encrypt(log_data)
-
-    encrypted_log_file_path = f'{config.REPOSITORY_PATH}/log/encrypted_log.txt'
-    with open(encrypted_log_file_path, "wb") as encrypted_file:
-        encrypted_file.write(encrypted_data)
+    Parameters
+    ----------
+    file_path: str
+        Path of the file
 
-    return encrypted_log_file_path
+    Returns
+    -------
+    str
+        hexadecimal digest of the file content
+    """
+    with open(file_path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
 
 
 def strtodate(txt: str) -> datetime:
@@ -158,6 +193,8 @@ def send_report(reports: List[str]) -> None:
     reports: List[str]
         List of reports to send
     """
+    # sendmail is a custom local package, only required to send the report
+    from sendmail import sendmail
 
     # Concatenate reports
     reports = '\n\n****************\n\n'.join(reports)
@@ -1,37 +1,123 @@
 import os
-from update_cug import tools
+from update_cug import alma, crypto, matching, tools
+import numpy as np
 import pandas as pd
 import config
 import logging
+from collections import Counter, deque
 from datetime import date
-from almapiwrapper.users import fetch_users, User
-from typing import Optional
+from almapiwrapper.users import User
+from typing import Deque, Dict, Optional, Iterable, Iterator, List, Set, Tuple
+from update_cug.retry_queue import RetryQueue
+
+# Columns identifying a row of the source list in the current state table
+STATE_KEY_COLUMNS = ['last_name', 'first_name', 'birth_date', 'barcode']
+
+# Columns of the current state table tracking the process of a row, with their initial values
+STATE_COLUMNS = ['primary_id', 'barcode_added', 'cug_updated', 'skipped', 'message']
+INITIAL_STATE = ('', False, False, False, '')
+
+# Types of the text columns of the current state table, barcodes keep their leading zeros
+STATE_DTYPES = {'last_name': str, 'first_name': str, 'barcode': str, 'primary_id': str, 'message': str}
+
+# Name of the workflow in the retry queue
+RETRY_WORKFLOW = 'mediotheken'
 
 
 def workflow() -> str:
     """
     This function is the main workflow of the process to update the CUG of Mediotheken users.
 
+    The source list is processed in chunks of CHUNK_SIZE rows, each chunk is written in
+    the current state table when processed. The previous current state table is read
+    alongside the source list, see `PreviousState`.
+
     Returns
     -------
     str
         string containing the report data
     """
 
-    # Load source data
-    df_source = tools.decrypt_data(config.PATH_TO_SOURCE_DATA)
+    # Each file is decrypted once, the tables are parsed chunk by chunk
+    source_data = crypto.decrypt_file(config.PATH_TO_SOURCE_DATA)
+    previous_state = load_previous_state()
+
+    # Rows of the whole list sharing a last name are searched together, even in different chunks
+    retry_queue = RetryQueue()
+    candidate_search, nb_rows = load_candidate_search(source_data, previous_state, retry_queue)
+
+    # Actualize the chunks of the source data with the state of the previous run,
+    # iterate on each user, failed operations are stored in the retry queue
+    report_counts = Counter()
+    matched_members = set()
+    chunks = process_chunks(iter_current_state_chunks(source_data, previous_state), retry_queue, report_counts,
+                            candidate_search, nb_rows, matched_members)
+
+    # Save the current state table chunk by chunk
+    tools.encrypt_data_chunks(chunks, config.PATH_TO_DATA_CURRENT_STATE, STATE_KEY_COLUMNS + STATE_COLUMNS)
+    retry_queue.save()
+    candidate_search.log_stats()
+
+    # Users matched in the previous run whose rows left the list lose the CUG with the reconciliation
+    record_departed_members(previous_state.get_dropped_members(), matched_members)
+
+    # Write the report
+    return update_report(report_counts)
+
+
+def load_source_data() -> pd.DataFrame:
+    """Decrypt and clean the source list provided by ABN
+
+    Returns
+    -------
+    pd.DataFrame
+        Source data with columns last_name, first_name, birth_date and barcode
+    """
+    return clean_source_data(tools.decrypt_data(config.PATH_TO_SOURCE_DATA, dtype=str))
+
+
+def clean_source_data(df_source: pd.DataFrame) -> pd.DataFrame:
+    """Rename the columns and convert the types of the source list
 
+    Parameters
+    ----------
+    df_source: pd.DataFrame
+        Source data or chunk of the source data, read as strings
+
+    Returns
+    -------
+    pd.DataFrame
+        Source data with columns last_name, first_name, birth_date and barcode
+    """
     # Rename the columns of the source data, order must be last_name, first_name, birth_date, barcode
     df_source.columns = ['last_name', 'first_name', 'birth_date', 'barcode']
     df_source['birth_date'] = pd.to_datetime(df_source['birth_date'], format='%Y-%m-%d')
 
     # Since data is read as string. Not available values are read as 'nan' string
     # => need to be replaced with empty string
-    df_source['barcode'] = df_source['barcode'].astype(str).replace('nan', '')
+    df_source['barcode'] = df_source['barcode'].fillna('').astype(str).replace('nan', '')
+
+    return df_source
+
 
+def load_current_state(df_source: pd.DataFrame) -> pd.DataFrame:
+    """Load the current state table and actualize it with the source data
+
+    If no current state table exists, a new one is created.
+
+    Parameters
+    ----------
+    df_source: pd.DataFrame
+        Source data
+
+    Returns
+    -------
+    pd.DataFrame
+        Actualized current state data
+    """
     # Check if current state table exists, if no a new one is created
     if os.path.isfile(config.PATH_TO_DATA_CURRENT_STATE) is True:
-        df_current_state = tools.decrypt_data(config.PATH_TO_DATA_CURRENT_STATE)
+        df_current_state = tools.decrypt_data(config.PATH_TO_DATA_CURRENT_STATE, dtype=STATE_DTYPES)
         logging.info('Current state table loaded.')
     else:
         logging.warning('No current state table -> creating a new one.')
@@ -39,25 +125,400 @@ def workflow() -> str:
 
     # Actualize the current state table, compare the current state with the source data
     # If source data changed, the current state is also updated.
-    df_current_state = actualize_current_state_table(df_source, df_current_state)
+    return actualize_current_state_table(df_source, df_current_state)
+
+
+class PreviousState:
+    """
+    State of the rows of the previous run, read alongside the chunks of the source list
+
+    The current state table is written in the order of the source list, the states of a
+    chunk are in the next rows of the table: the table is read chunk by chunk when a state
+    is missing. Only the states read and not used yet are kept, those of the rows moved in
+    the list or which left it. The sorted hashes of the keys of the rows with a state tell
+    which rows have a state to read. Rows with the initial state are not kept.
+
+    Attributes:
+    -----------
+    data: bytes
+        Decrypted current state table, empty if no table exists
+    hashes: np.ndarray
+        Sorted hashes of the keys of the rows with a state, see `get_row_keys`
+    cug_updated: np.ndarray
+        Value of the cug_updated column of the row of each hash
+    chunks: Iterator[Tuple[pd.Series, List[Tuple]]]
+        Keys and states of the rows with a state of the next chunks of the table
+    pending: Dict[str, Deque[Tuple]]
+        States read and not used yet, by row key
+    """
+    def __init__(self, data: bytes = b''):
+        self.data = data
+        self.pending: Dict[str, Deque[Tuple]] = dict()
+
+        hashes = [np.empty(0, dtype=np.uint64)]
+        cug_updated = [np.empty(0, dtype=bool)]
+        for keys, states in self.iter_states():
+            hashes.append(get_key_hashes(keys))
+            cug_updated.append(np.array([state[2] for state in states], dtype=bool))
+
+        hashes = np.concatenate(hashes)
+        order = np.argsort(hashes, kind='stable')
+        self.hashes = hashes[order]
+        self.cug_updated = np.concatenate(cug_updated)[order]
+        self.chunks = self.iter_states()
+
+    def iter_states(self) -> Iterator[Tuple[pd.Series, List[Tuple]]]:
+        """
+        Read the table chunk by chunk and return the keys and states of the rows with a state
+        """
+        for chunk in tools.read_data_chunks(self.data, config.CHUNK_SIZE, dtype=STATE_DTYPES):
+            chunk = clean_current_state_table_col_types(chunk)
+            chunk['primary_id'] = chunk['primary_id'].fillna('')
+            states = list(chunk[STATE_COLUMNS].itertuples(index=False, name=None))
+            has_state = [state != INITIAL_STATE for state in states]
+
+            yield get_row_keys(chunk)[has_state], [state for state in states if state != INITIAL_STATE]
+
+    def find(self, keys: pd.Series) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Return the positions of the keys in the hashes and if the rows have a state
+        """
+        if len(self.hashes) == 0:
+            return np.zeros(len(keys), dtype=int), np.zeros(len(keys), dtype=bool)
+
+        hashes = get_key_hashes(keys)
+        positions = np.minimum(np.searchsorted(self.hashes, hashes), len(self.hashes) - 1)
+
+        return positions, self.hashes[positions] == hashes
+
+    def is_cug_updated(self, keys: pd.Series) -> np.ndarray:
+        """
+        Return True for the rows whose CUG was updated in the previous run
+        """
+        positions, has_state = self.find(keys)
+        if len(self.hashes) == 0:
+            return has_state
+
+        return has_state & self.cug_updated[positions]
+
+    def read_chunk(self) -> bool:
+        """
+        Add the states of the next chunk of the table to the pending states, False at the end of the table
+        """
+        keys, states = next(self.chunks, (None, None))
+        if keys is None:
+            return False
+
+        for key, state in zip(keys, states):
+            self.pending.setdefault(key, deque()).append(state)
+
+        return True
+
+    def get_states(self, keys: pd.Series) -> List[Tuple]:
+        """
+        Return the states of rows of the source list, the initial state for the new rows
+
+        Each state is used once, duplicated rows use the states of the duplicated rows of the table.
+        """
+        states = []
+
+        for key, has_state in zip(keys, self.find(keys)[1]):
+            while has_state and key not in self.pending and self.read_chunk():
+                pass
+
+            if key not in self.pending:
+                states.append(INITIAL_STATE)
+                continue
+
+            states.append(self.pending[key].popleft())
+            if len(self.pending[key]) == 0:
+                del self.pending[key]
+
+        return states
+
+    def get_dropped_members(self) -> Set[str]:
+        """
+        Return the primary IDs of the matched users of the rows without state used, skipped users excepted
+
+        To call once the whole source list is read, these rows left the list.
+        """
+        while self.read_chunk():
+            pass
+
+        return {state[0] for states in self.pending.values() for state in states if state[0] != '' and not state[3]}
+
+
+def get_key_hashes(keys: pd.Series) -> np.ndarray:
+    """Return the hashes of row keys, see `get_row_keys`
+
+    Parameters
+    ----------
+    keys: pd.Series
+        Keys of rows
+
+    Returns
+    -------
+    np.ndarray
+        Hashes of the keys
+    """
+    return pd.util.hash_pandas_object(keys, index=False).to_numpy()
+
+
+def load_previous_state() -> PreviousState:
+    """Decrypt the current state table of the previous run
+
+    Returns
+    -------
+    PreviousState
+        State of the rows of the previous run, without state if no current state table exists
+    """
+    if os.path.isfile(config.PATH_TO_DATA_CURRENT_STATE) is False:
+        logging.warning('No current state table -> creating a new one.')
+        return PreviousState()
+
+    previous_state = PreviousState(crypto.decrypt_file(config.PATH_TO_DATA_CURRENT_STATE))
+    logging.info(f'Current state table loaded: {len(previous_state.hashes)} rows with a state.')
+
+    return previous_state
+
+
+def iter_source_chunks(source_data: bytes) -> Iterator[pd.DataFrame]:
+    """Read the decrypted source data chunk by chunk
+
+    Parameters
+    ----------
+    source_data: bytes
+        Decrypted source data
 
-    # Iterate on each user
-    for i, _ in df_current_state.iterrows():
+    Returns
+    -------
+    Iterator[pd.DataFrame]
+        Chunks of the source data, indexed by the position of the rows in the source list
+    """
+    nb_rows = 0
+
+    for chunk in tools.read_data_chunks(source_data, config.CHUNK_SIZE, dtype=str):
+        chunk = clean_source_data(chunk)
+        chunk.index = pd.RangeIndex(nb_rows, nb_rows + len(chunk))
+        nb_rows += len(chunk)
+
+        yield chunk
+
+
+def iter_current_state_chunks(source_data: bytes, previous_state: PreviousState) -> Iterator[pd.DataFrame]:
+    """Read the source data chunk by chunk and actualize each chunk with the state of the previous run
+
+    Like `actualize_current_state_table`, rows missing in the source data are dropped and new rows
+    get the initial state.
+
+    Parameters
+    ----------
+    source_data: bytes
+        Decrypted source data
+    previous_state: PreviousState
+        State of the rows of the previous run, see `load_previous_state`
+
+    Returns
+    -------
+    Iterator[pd.DataFrame]
+        Chunks of the actualized current state data, indexed by the position of the rows in the source list
+    """
+    for chunk in iter_source_chunks(source_data):
+        states = previous_state.get_states(get_row_keys(chunk))
+        chunk[STATE_COLUMNS] = pd.DataFrame(states, columns=STATE_COLUMNS, index=chunk.index)
+
+        yield clean_current_state_table_col_types(chunk)
+
+
+def load_candidate_search(source_data: bytes,
+                          previous_state: PreviousState,
+                          retry_queue: RetryQueue) -> Tuple[matching.CandidateSearch, int]:
+    """Add the rows of the whole source list to process to the blocks of a candidate search
+
+    The source list is read chunk by chunk, only the match keys of the rows whose CUG was not
+    updated in the previous run are added to the search.
+
+    Parameters
+    ----------
+    source_data: bytes
+        Decrypted source data
+    previous_state: PreviousState
+        State of the rows of the previous run, see `load_previous_state`
+    retry_queue: RetryQueue
+        Queue of the failed operations, rows not eligible for retry are not processed
+
+    Returns
+    -------
+    Tuple[matching.CandidateSearch, int]
+        Search of the candidates and number of rows of the source list
+    """
+    candidate_search = matching.CandidateSearch()
+    nb_rows = 0
+
+    for chunk in iter_source_chunks(source_data):
+        keys = get_row_keys(chunk)
+        keys = keys[~previous_state.is_cug_updated(keys)]
+        indexes = [i for i, key in keys.items() if retry_queue.is_eligible(RETRY_WORKFLOW, key)]
+        candidate_search.add_rows(matching.get_match_keys(chunk.loc[indexes]))
+        nb_rows += len(chunk)
+
+    logging.info(f'Source list read: {nb_rows} rows, {len(candidate_search.block_sizes)} last names to search')
+
+    return candidate_search, nb_rows
+
+
+def process_chunks(chunks: Iterable[pd.DataFrame],
+                   retry_queue: RetryQueue,
+                   report_counts: Counter,
+                   candidate_search: matching.CandidateSearch,
+                   nb_rows: int,
+                   matched_members: Set[str]) -> Iterator[pd.DataFrame]:
+    """Process the users of each chunk of the current state table
+
+    Parameters
+    ----------
+    chunks: Iterable[pd.DataFrame]
+        Chunks of the current state data
+    retry_queue: RetryQueue
+        Queue of the failed operations
+    report_counts: Counter
+        Counts of the report, updated with each processed chunk
+    candidate_search: matching.CandidateSearch
+        Search of the candidates of all the chunks, see `load_candidate_search`
+    nb_rows: int
+        Number of rows of the source list
+    matched_members: Set[str]
+        Primary IDs of the matched users, updated with each processed chunk
+
+    Returns
+    -------
+    Iterator[pd.DataFrame]
+        Processed chunks
+    """
+    for chunk in chunks:
+        if len(chunk) == 0:
+            continue
+
+        logging.info(f'Processing rows {chunk.index[0] + 1} to {chunk.index[-1] + 1} of {nb_rows} rows '
+                     f'of the source list')
+        process_users(chunk, retry_queue, candidate_search=candidate_search, nb_rows=nb_rows)
+        report_counts.update(get_report_counts(chunk))
+        matched_members.update(get_matched_members(chunk))
+
+        yield chunk
+
+
+def get_rows_to_process(df_current_state: pd.DataFrame,
+                        retry_queue: RetryQueue,
+                        indexes: Optional[Iterable[int]] = None) -> List[int]:
+    """Return the rows of the current state table to process
+
+    Rows with failed operations are not processed before the next eligible time.
+
+    Parameters
+    ----------
+    df_current_state: pd.DataFrame
+        Current state data
+    retry_queue: RetryQueue
+        Queue of the failed operations
+    indexes: Iterable[int], optional
+        Indexes of the rows to check, all rows are checked if not provided
+
+    Returns
+    -------
+    List[int]
+        Indexes of the rows to process
+    """
+    if indexes is None:
+        indexes = df_current_state.index
+
+    return [i for i in indexes
+            if (df_current_state.loc[i, 'cug_updated'] and df_current_state.loc[i, 'barcode_added'])
+            or retry_queue.is_eligible(RETRY_WORKFLOW, get_row_key(df_current_state, i))]
+
+
+def process_users(df_current_state: pd.DataFrame,
+                  retry_queue: RetryQueue,
+                  indexes: Optional[Iterable[int]] = None,
+                  candidate_search: Optional[matching.CandidateSearch] = None,
+                  nb_rows: Optional[int] = None) -> None:
+    """Update the CUG and check the barcode of the users of the current state table
+
+    Parameters
+    ----------
+    df_current_state: pd.DataFrame
+        Current state data or chunk of it, updated in place
+    retry_queue: RetryQueue
+        Queue of the failed operations, rows with failed operations are only processed when eligible
+    indexes: Iterable[int], optional
+        Indexes of the rows to process, all rows are processed if not provided
+    candidate_search: matching.CandidateSearch, optional
+        Search of the candidates with the rows to process already added, by default a search
+        of the rows to process of `df_current_state`
+    nb_rows: int, optional
+        Number of rows of the source list, for the progress logs, by default the number of rows of
+        `df_current_state`
+    """
+    if indexes is None:
+        indexes = df_current_state.index
+    if nb_rows is None:
+        nb_rows = len(df_current_state)
+
+    rows = get_rows_to_process(df_current_state, retry_queue, indexes)
+
+    # Failed operations are not retried before the next eligible time
+    for i in sorted(set(indexes) - set(rows)):
+        logging.info(f'{i + 1} / {nb_rows}: SKIPPED {df_current_state.loc[i, "barcode"]}, '
+                     f'failed operation not eligible for retry')
+
+    # Match keys of all rows are computed at once, rows sharing a last name share the search
+    keys = matching.get_match_keys(df_current_state.loc[rows])
+    is_new_search = candidate_search is None
+    if is_new_search is True:
+        candidate_search = matching.CandidateSearch()
+        candidate_search.add_rows(keys.loc[[i for i in rows if not df_current_state.loc[i, 'cug_updated']]])
+
+    for i in rows:
 
         # Check CUG of the user
-        user = update_user_cug(i, df_current_state)
+        user = update_user_cug(i, df_current_state, retry_queue, candidate_search, keys.loc[i], nb_rows)
 
         # Check barcode for users, who have already the new CUG, but no barcode
         if not df_current_state.loc[i, 'barcode_added'] and df_current_state.loc[i, 'cug_updated']:
             if user is None:
-                user = User(df_current_state.loc[i, 'primary_id'], zone=config.IZ)
-                _ = user.data
+                user, error_msg = alma.fetch_user(df_current_state.loc[i, 'primary_id'])
+                if error_msg is not None:
+                    retry_queue.record_failure(RETRY_WORKFLOW, get_row_key(df_current_state, i), 'get', error_msg)
+                    continue
+
+            df_current_state.loc[i, 'barcode_added'] = check_user_barcode(user, df_current_state.loc[i, 'barcode'])
+            retry_queue.record_success(RETRY_WORKFLOW, get_row_key(df_current_state, i))
+
+    if is_new_search is True:
+        candidate_search.log_stats()
+
 
-            if user.error is False:
-                df_current_state.loc[i, 'barcode_added'] = check_user_barcode(user, df_current_state.loc[i, 'barcode'])
+def save_current_state(df_current_state: pd.DataFrame) -> str:
+    """Write the report and save the encrypted current state table
 
+    Parameters
+    ----------
+    df_current_state: pd.DataFrame
+        Current state data
+
+    Returns
+    -------
+    str
+        string containing the report data
+    """
     # Write the report
-    report = update_report(df_current_state)
+    report = update_report(get_report_counts(df_current_state))
+
+    # Users matched in the previous version whose rows left the list lose the CUG with the reconciliation
+    if os.path.isfile(config.PATH_TO_DATA_CURRENT_STATE):
+        df_previous_state = clean_current_state_table_col_types(
+            tools.decrypt_data(config.PATH_TO_DATA_CURRENT_STATE, dtype=STATE_DTYPES))
+        record_departed_members(get_desired_members(df_previous_state), get_matched_members(df_current_state))
 
     # Save the current state table
     tools.encrypt_data(df_current_state, config.PATH_TO_DATA_CURRENT_STATE)
@@ -70,19 +531,12 @@ def reset_current_state_table() -> None:
 
     This script can be used in case of error in the current state table.
     """
-    df_source = tools.decrypt_data(config.PATH_TO_SOURCE_DATA)
-    df_source.columns = ['last_name', 'first_name', 'birth_date', 'barcode']
-    df_source['birth_date'] = pd.to_datetime(df_source['birth_date'], format='%Y-%m-%d')
-    df_source['barcode'] = df_source['barcode'].astype(str).replace('nan', '')
-
     logging.info('Create a new current state table.')
-    df_current_state = create_current_state_df(df_source)
-
-    # Actualize the current state table
-    df_current_state = actualize_current_state_table(df_source, df_current_state)
 
-    # Save the current state table
-    tools.encrypt_data(df_current_state, config.PATH_TO_DATA_CURRENT_STATE)
+    # All rows of the source data get the initial state
+    source_data = crypto.decrypt_file(config.PATH_TO_SOURCE_DATA)
+    chunks = iter_current_state_chunks(source_data, PreviousState())
+    tools.encrypt_data_chunks(chunks, config.PATH_TO_DATA_CURRENT_STATE, STATE_KEY_COLUMNS + STATE_COLUMNS)
 
 
 def create_current_state_df(df_source) -> pd.DataFrame:
@@ -124,7 +578,7 @@ def actualize_current_state_table(df_source: pd.DataFrame, df_current_state: pd.
     df_current_state = clean_current_state_table_col_types(df_current_state)
 
     df_current_state = df_source.merge(df_current_state,
-                                       on=['last_name', 'first_name', 'birth_date', 'barcode'],
+                                       on=STATE_KEY_COLUMNS,
                                        how='left')
 
     df_current_state = clean_current_state_table_col_types(df_current_state)
@@ -132,7 +586,174 @@ def actualize_current_state_table(df_source: pd.DataFrame, df_current_state: pd.
     return df_current_state
 
 
-def update_user_cug(i: int, df: pd.DataFrame) -> Optional[User]:
+def get_new_rows(df_current_state: pd.DataFrame, df_previous_state: pd.DataFrame) -> List[int]:
+    """Return the indexes of the rows of the current state table missing in a previous version of it
+
+    Parameters
+    ----------
+    df_current_state: pd.DataFrame
+        Actualized current state data
+    df_previous_state: pd.DataFrame
+        Current state data before the actualization
+
+    Returns
+    -------
+    List[int]
+        Indexes of the new rows in the actualized current state data
+    """
+    previous_keys = pd.MultiIndex.from_frame(df_previous_state[STATE_KEY_COLUMNS])
+    is_new = ~pd.MultiIndex.from_frame(df_current_state[STATE_KEY_COLUMNS]).isin(previous_keys)
+
+    return df_current_state.index[is_new].tolist()
+
+
+def get_row_key(df: pd.DataFrame, i: int) -> str:
+    """Return the key identifying a row of the current state table in the retry queue
+
+    Parameters
+    ----------
+    df: pd.DataFrame
+        Current state data
+    i: int
+        Index of the row
+
+    Returns
+    -------
+    str
+        Values of the key columns separated by '|'
+    """
+    return (f'{df.loc[i, "last_name"]}|{df.loc[i, "first_name"]}|'
+            f'{df.loc[i, "birth_date"].strftime("%Y-%m-%d")}|{df.loc[i, "barcode"]}')
+
+
+def get_row_keys(df: pd.DataFrame) -> pd.Series:
+    """Return the keys of all the rows of the current state table, see `get_row_key`
+
+    Parameters
+    ----------
+    df: pd.DataFrame
+        Current state data
+
+    Returns
+    -------
+    pd.Series
+        Keys of the rows, with the index of the current state data
+    """
+    return (df['last_name'].map(str) + '|' + df['first_name'].map(str) + '|'
+            + df['birth_date'].dt.strftime('%Y-%m-%d') + '|' + df['barcode'].map(str))
+
+
+def get_desired_members(df_current_state: pd.DataFrame) -> Set[str]:
+    """Return the primary IDs of the users who must have the Mediotheken CUG
+
+    These are the matched users of the current state table, skipped users excepted.
+
+    Parameters
+    ----------
+    df_current_state: pd.DataFrame
+        Current state data
+
+    Returns
+    -------
+    Set[str]
+        Set of primary IDs
+    """
+    primary_ids = df_current_state['primary_id'].fillna('').astype(str)
+
+    return set(primary_ids.loc[(primary_ids != '') & ~df_current_state['skipped']])
+
+
+def get_skipped_members(df_current_state: pd.DataFrame) -> Set[str]:
+    """Return the primary IDs of the matched users flagged as skipped
+
+    These users must not be processed, the CUG is neither added nor removed.
+
+    Parameters
+    ----------
+    df_current_state: pd.DataFrame
+        Current state data
+
+    Returns
+    -------
+    Set[str]
+        Set of primary IDs
+    """
+    primary_ids = df_current_state['primary_id'].fillna('').astype(str)
+
+    return set(primary_ids.loc[(primary_ids != '') & df_current_state['skipped']])
+
+
+def get_matched_members(df_current_state: pd.DataFrame) -> Set[str]:
+    """Return the primary IDs of the matched users, skipped users included
+
+    Parameters
+    ----------
+    df_current_state: pd.DataFrame
+        Current state data
+
+    Returns
+    -------
+    Set[str]
+        Set of primary IDs
+    """
+    primary_ids = df_current_state['primary_id'].fillna('').astype(str)
+
+    return set(primary_ids.loc[primary_ids != ''])
+
+
+def load_departed_members() -> Set[str]:
+    """Load the primary IDs of the matched users who left the Mediotheken list
+
+    Only these users can lose the CUG with the reconciliation, users who were never
+    matched, for example skipped rows without primary ID, keep it.
+
+    Returns
+    -------
+    Set[str]
+        Set of primary IDs, empty if the file doesn't exist
+    """
+    if os.path.isfile(config.PATH_TO_DEPARTED_MEMBERS) is False:
+        return set()
+
+    return set(tools.decrypt_data(config.PATH_TO_DEPARTED_MEMBERS, dtype=str)['primary_id'])
+
+
+def save_departed_members(primary_ids: Set[str]) -> None:
+    """Encrypt and write the primary IDs of the matched users who left the Mediotheken list
+
+    Parameters
+    ----------
+    primary_ids: Set[str]
+        Set of primary IDs
+    """
+    tools.encrypt_data(pd.DataFrame({'primary_id': sorted(primary_ids)}), config.PATH_TO_DEPARTED_MEMBERS)
+
+
+def record_departed_members(previous_members: Set[str], current_members: Set[str]) -> None:
+    """Add the users matched in the previous state and not anymore to the departed members
+
+    Parameters
+    ----------
+    previous_members: Set[str]
+        Primary IDs of the matched users of the previous state, skipped users excepted
+    current_members: Set[str]
+        Primary IDs of the matched users of the current state, see `get_matched_members`
+    """
+    departed = previous_members - current_members
+
+    if len(departed) == 0:
+        return
+
+    logging.info(f'{len(departed)} matched users left the Mediotheken list')
+    save_departed_members(load_departed_members() | departed)
+
+
+def update_user_cug(i: int,
+                    df: pd.DataFrame,
+                    retry_queue: RetryQueue,
+                    candidate_search: matching.CandidateSearch,
+                    row_keys: pd.Series,
+                    nb_rows: int) -> Optional[User]:
     """This function fetch user and update it in the NZ. It check also the IZ
     user to know if it has already the new user group.
 
@@ -143,55 +764,80 @@ def update_user_cug(i: int, df: pd.DataFrame) -> Optional[User]:
 
     df: pd.DataFrame
         DataFrame containing the current state of the data from the last run.
+
+    retry_queue: RetryQueue
+        Queue where failed operations are recorded
+
+    candidate_search: matching.CandidateSearch
+        Search of the accounts matching the names of the rows
+
+    row_keys: pd.Series
+        Match keys of the row, see `matching.get_match_keys`
+
+    nb_rows: int
+        Number of rows of the source list, for the progress logs
     """
 
     # This user is already fully processed => skip it
     if df.loc[i, 'cug_updated']:
-        logging.info(f'{i + 1} / {len(df)}: SKIPPED {df.loc[i, "barcode"]}')
+        logging.info(f'{i + 1} / {nb_rows}: SKIPPED {df.loc[i, "barcode"]}')
         return
 
     df.loc[i, 'message'] = ''
-    logging.info(f'{i + 1} / {len(df)}: handling {df.loc[i, "barcode"]}')
-
-    # Fetch users by name
-    users = [u for u in
-             fetch_users(f'last_name~{df.loc[i, "last_name"].replace(" ", "_")} '
-                         f'and first_name~{df.loc[i, "first_name"].replace(" ", "_")}',
-                         zone=config.IZ)
-             if u.primary_id.endswith('eduid.ch')]
+    logging.info(f'{i + 1} / {nb_rows}: handling {df.loc[i, "barcode"]}')
+    key = get_row_key(df, i)
+
+    # Fetch eduID accounts matching the name keys
+    primary_ids, error_msg = candidate_search.get_candidates(row_keys)
+    if error_msg is not None:
+        retry_queue.record_failure(RETRY_WORKFLOW, key, 'search', error_msg)
+        df.loc[i, 'message'] = 'Error searching user'
+        return
 
-    if len(users) == 0:
+    if len(primary_ids) == 0:
         logging.warning(f'No match found with name {df.loc[i, "last_name"]}, {df.loc[i, "first_name"]}')
+        retry_queue.record_success(RETRY_WORKFLOW, key)
         return
 
+    # Fetch data of the candidates
+    users = []
+    for primary_id in primary_ids:
+        user, error_msg = alma.fetch_user(primary_id)
+        if error_msg is not None:
+            retry_queue.record_failure(RETRY_WORKFLOW, key, 'get', error_msg)
+            df.loc[i, 'message'] = 'Error fetching user'
+            return
+        users.append(user)
+
     # Filter with birth date
-    users_found = [u for u in users if df.loc[i, 'birth_date'] == tools.strtodate(u.data['birth_date'])]
+    birth_date_key = row_keys['birth_date_key']
+    users_found = [u for u in users if matching.get_birth_date_key(u.data) == birth_date_key]
 
     # Multi matches case
     if len(users_found) > 1:
         logging.error(
-            f'Several accounts with same name and same birth date ({df.loc[i, "Name"]}, {df.loc[i, "Vorname"]}), '
+            f'Several accounts with same name and same birth date ({df.loc[i, "last_name"]}, '
+            f'{df.loc[i, "first_name"]}), '
             f'probably duplicated accounts => SKIPPED: {", ".join([u.primary_id for u in users_found])}')
         df.loc[i, 'skipped'] = True
         df.loc[i, 'message'] = (f'Several accounts with same name and same birth date ({df.loc[i, "last_name"]}, '
                                 f'{df.loc[i, "first_name"]}), probably duplicated accounts => SKIPPED: '
                                 f'{", ".join([u.primary_id for u in users_found])}')
+        retry_queue.record_success(RETRY_WORKFLOW, key)
         return
 
     # No match case
     if len(users_found) == 0:
+        found_birth_dates = ", ".join([f'{u.primary_id} ({matching.get_birth_date_key(u.data)})' for u in users])
         logging.warning(
             f'Match found with name {df.loc[i, "last_name"]}, {df.loc[i, "first_name"]}, '
-            f'but no match with birth date: looking for {df.loc[i, "birth_date"].strftime("%Y-%m-%d")} / '
-            f'found in alma accounts '
-            f'{", ".join([u.primary_id + " (" + u.data["birth_date"][:-1] + ")" for u in users])}')
+            f'but no match with birth date: looking for {birth_date_key} / '
+            f'found in alma accounts {found_birth_dates}')
 
         df.loc[i, 'message'] = (f'Match found with name {df.loc[i, "last_name"]}, {df.loc[i, "first_name"]}, '
-                                f'but no match with birth date: looking for'
-                                f'{df.loc[i, "birth_date"].strftime("%Y-%m-%d")} / '
-                                f'found in alma accounts '
-                                f'{", ".join([u.primary_id + " (" + u.data["birth_date"][:-1] + ")" for u in users])} '
-                                f'=> SKIPPED')
+                                f'but no match with birth date: looking for {birth_date_key} / '
+                                f'found in alma accounts {found_birth_dates} => SKIPPED')
+        retry_queue.record_success(RETRY_WORKFLOW, key)
         return
 
     # Handle account
@@ -203,19 +849,22 @@ def update_user_cug(i: int, df: pd.DataFrame) -> Optional[User]:
         # We set the flag "updated" to True to avoid new tests on this user
         df.loc[i, 'cug_updated'] = True
         logging.info(f'{user_iz.primary_id}: user group already "{config.MEDIOTHEK_USER_GROUP_CODE}"')
+        retry_queue.record_success(RETRY_WORKFLOW, key)
         return user_iz
     else:
         # Update the user group
         user_iz.data['user_group']['value'] = config.MEDIOTHEK_USER_GROUP_CODE
-        user_iz.update(override=['user_group'])
+        user_iz, error_msg = alma.update_user(user_iz, override=['user_group'])
 
-        if user_iz.error is False:
+        if error_msg is None:
             logging.info(f'{user_iz.primary_id}: user group updated to "{config.MEDIOTHEK_USER_GROUP_CODE}"')
             df.loc[i, 'cug_updated'] = True
+            retry_queue.record_success(RETRY_WORKFLOW, key)
             return user_iz
         else:
             logging.error(f'{user_iz.primary_id}: error updating user group')
             df.loc[i, 'message'] = 'Error updating user group'
+            retry_queue.record_failure(RETRY_WORKFLOW, key, 'put', error_msg)
             return
 
 
@@ -252,18 +901,37 @@ def clean_current_state_table_col_types(df_current_state: pd.DataFrame) -> pd.Da
     df_current_state['barcode_added'] = df_current_state['barcode_added'].fillna(False).astype(bool)
     df_current_state['cug_updated'] = df_current_state['cug_updated'].fillna(False).astype(bool)
     df_current_state['skipped'] = df_current_state['skipped'].fillna(False).astype(bool)
-    df_current_state['message'] = df_current_state['message'].astype(str).replace('nan', '')
-    df_current_state['barcode'] = df_current_state['barcode'].astype(str).replace('nan', '')
+    df_current_state['message'] = df_current_state['message'].fillna('').astype(str).replace('nan', '')
+    df_current_state['barcode'] = df_current_state['barcode'].fillna('').astype(str).replace('nan', '')
     return df_current_state
 
 
-def update_report(df_current_state: pd.DataFrame) -> str:
-    """Write the report of the process in a file
+def get_report_counts(df_current_state: pd.DataFrame) -> Dict[str, int]:
+    """Count the users of the current state table for the report
 
     Parameters
     ----------
     df_current_state: pd.DataFrame
-        DataFrame containing the report data
+        Current state data or chunk of it
+
+    Returns
+    -------
+    Dict[str, int]
+        Number of users, of updated users, of users with barcode and of skipped users
+    """
+    return {'nb_users': len(df_current_state),
+            'nb_users_updated': int(df_current_state['cug_updated'].sum()),
+            'nb_barcode_added': int(df_current_state['barcode_added'].sum()),
+            'nb_users_skipped': int(df_current_state['skipped'].sum())}
+
+
+def update_report(report_counts: Dict[str, int]) -> str:
+    """Write the report of the process in a file
+
+    Parameters
+    ----------
+    report_counts: Dict[str, int]
+        Counts of the users, see `get_report_counts`
 
     Returns
     -------
@@ -282,10 +950,10 @@ def update_report(df_current_state: pd.DataFrame) -> str:
         df = pd.DataFrame(columns=['date', 'nb_users', 'nb_users_updated', 'nb_barcode_added', 'nb_users_skipped'])
 
     df.loc[len(df)] = {'date': date.today().isoformat(),
-                       'nb_users': len(df_current_state),
-                       'nb_users_updated': len(df_current_state[df_current_state['cug_updated']]),
-                       'nb_barcode_added': len(df_current_state[df_current_state['barcode_added']]),
-                       'nb_users_skipped': len(df_current_state[df_current_state['skipped']])}
+                       'nb_users': report_counts['nb_users'],
+                       'nb_users_updated': report_counts['nb_users_updated'],
+                       'nb_barcode_added': report_counts['nb_barcode_added'],
+                       'nb_users_skipped': report_counts['nb_users_skipped']}
 
     df.to_csv(config.PATH_TO_REPORT_MEDIOTHEKEN, index=False)
 
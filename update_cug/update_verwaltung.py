@@ -1,39 +1,69 @@
-from typing import List
+import re
+from typing import Dict, List, Optional, Set
 from datetime import date
 import pandas as pd
 import os
 from almapiwrapper.analytics import AnalyticsReport
-from almapiwrapper.users import User
 import config
 
+# Email address with domain ag.ch or one of its sub domains
+AG_CH_EMAIL_PATTERN = r'@(?:[a-z0-9-]+\.)*ag\.ch$'
 
-def workflow() -> str:
+
+def get_desired_members(snapshot: pd.DataFrame) -> Set[str]:
     """
-    Update the user group of users with an email address ending with 'ag.ch' and not already
-    in the user group 'ABN_Patron-Kantonale-Verwaltung'
+    Return the primary IDs of the users who must have the user group 'ABN_Patron-Kantonale-Verwaltung'
+
+    Each user with an email address with domain 'ag.ch' must have the CUG, except the users
+    of the HFGS user group.
+
+    Parameters
+    ----------
+    snapshot: pd.DataFrame
+        Membership snapshot with columns primary_id, user_group and email
 
     Returns
     -------
-    str
-        string containing the report data
+    Set[str]
+        Set of primary IDs
     """
-    primary_ids = fetch_analytics_report()
+    has_ag_ch_email = snapshot['email'].str.lower().str.contains(AG_CH_EMAIL_PATTERN, regex=True)
+    is_hfgs = snapshot['user_group'] == config.HFGS_USER_GROUP_CODE
 
-    update_users(primary_ids)
+    return set(snapshot.loc[has_ag_ch_email & ~is_hfgs, 'primary_id'])
 
-    report = update_report(primary_ids)
 
-    return report
+def has_ag_ch_email(user_data: Dict) -> bool:
+    """
+    Check if one of the email addresses of an Alma user has the domain 'ag.ch'
 
+    Parameters
+    ----------
+    user_data: Dict
+        Data of the user
 
-def fetch_analytics_report() -> List[str]:
+    Returns
+    -------
+    bool
+        True if the user has an ag.ch email address
     """
-    Fetch the analytics report and return the list of primary IDs of users to update
+    emails = (user_data.get('contact_info') or {}).get('email') or []
+
+    return any(re.search(AG_CH_EMAIL_PATTERN, (email.get('email_address') or '').strip().lower())
+               for email in emails)
+
+
+def fetch_analytics_report() -> Optional[List[str]]:
+    """
+    Fetch the analytics report of the users with an ag.ch email address and without the CUG
+
+    This report is used to add the CUG when the membership snapshot of the reconciliation
+    is not available, no user is removed in this case.
 
     Returns
     -------
-    List[str]
-        List of primary IDs of users to update
+    Optional[List[str]]
+        List of primary IDs of users to update, None if the report is not available
     """
 
     # A configured analytics read-only key is required
@@ -44,36 +74,14 @@ def fetch_analytics_report() -> List[str]:
 
     # Avoid critical error if the report is not found
     if report.error is True or data is None:
-        return []
+        return None
 
     # Filter data, additional check, analytics report should already be filtered
     filtered_data = data.loc[~data['User Group Code'].isin([config.HFGS_USER_GROUP_CODE,
                                                             config.MEDIOTHEK_USER_GROUP_CODE,
                                                             config.VERWALTUNG_USER_GROUP_CODE])]
-    primary_ids = filtered_data['Primary Identifier'].tolist()
-
-    # Limit to 50 users => limit risk in case of problem with analytics report
-    return primary_ids[:50]
-
-
-def update_users(primary_ids: List[str]):
-    """
-    Update the user group of the users
-
-    Parameters
-    ----------
-    primary_ids: List[str]
-        List of primary IDs of users to update
-    """
-    for primary_id in primary_ids:
-        # Fetch user data
-        u = User(primary_id, 'ABN')
-
-        # Define user group
-        u.data['user_group']['value'] = 'ABN_Patron-Kantonale-Verwaltung'
 
-        # Update user, override is required to update user group if there is already a user group change on the account
-        u.update(override=['user_group'])
+    return filtered_data['Primary Identifier'].astype(str).str.strip().tolist()
 
 
 def update_report(primary_ids: List[str]) -> str: